@@ -1,50 +1,370 @@
-from flask import Flask, request, jsonify
-from flask_pymongo import PyMongo
+from flask import (
+    Blueprint,
+    Flask,
+    current_app,
+    g,
+    request,
+    jsonify,
+    send_file,
+    stream_with_context,
+)
 from flask_cors import CORS
-from flask_bcrypt import Bcrypt
-from dotenv import load_dotenv
+import click
+from appConfig import defaultConfig
+from types import SimpleNamespace
 import os
-import json
+import hashlib
+import importlib.util
+import itertools
+import uuid
 import dataProcessing
 import dbHandling
 import dataExtractor
+import dataAnalytics
+import responseCache
+import responseCompression
+import exportCache
+import jobQueue
+import mongoConnection
+import passwordHashing
+import requestMetrics
+import functools
+import tempfile
+import threading
+import time
 
-# Load environment variables from a .env file
-load_dotenv()
 
-# Initialize the Flask app
-app = Flask(__name__)
-CORS(app)  # Enable Cross-Origin Resource Sharing for all routes
+def create_app(config=None):
+    """
+    Creates the Flask app and the services it uses (MongoDB connection, caches, job queue, password hasher).
 
-# Configure the app to use MongoDB
-app.config["MONGO_URI"] = os.getenv("MONGO_URI")
-mongo = PyMongo(app)  # Create a PyMongo instance to interact with MongoDB
-bcrypt = Bcrypt(app)  # Create a Bcrypt instance for password hashing
+    Args:
+        config (dict): Settings overriding those read from the environment (see defaultConfig).
+
+    Returns:
+        Flask: The configured app.
+    """
+    # Initialize the Flask app
+    app = Flask(__name__)
+    CORS(app)  # Enable Cross-Origin Resource Sharing for all routes
+    app.config.update(defaultConfig())
+    if config:
+        app.config.update(config)
+
+    if app.config["PRELOAD_EXPORT_LIBRARIES"]:
+        dataExtractor.preloadLibraries()
+
+    # Create the MongoDB connection; the client itself is created in every worker after the fork
+    mongo = mongoConnection.MongoConnection(app.config)
+
+    metrics = requestMetrics.MetricsRegistry()
+    app.extensions["anemia"] = SimpleNamespace(
+        config=app.config,
+        mongo=mongo,
+        metrics=metrics,
+        bcrypt=passwordHashing.PasswordHasher(
+            app.config["BCRYPT_LOG_ROUNDS"], app.config["BCRYPT_WORKERS"]
+        ),  # Create a password hasher for bcrypt hashing
+        tokens=passwordHashing.SessionTokens(
+            app.config["SECRET_KEY"], app.config["TOKEN_MAX_AGE"]
+        ),
+        responses=responseCache.ResponseCache(
+            app.config["CACHE_MAX_ENTRIES"], app.config["CACHE_TTL"]
+        ),
+        dataVersion=responseCache.DataVersion(app.config["DATA_VERSION_TTL"]),
+        compression=responseCompression.Compression(
+            app.config["COMPRESSION_ENCODINGS"],
+            app.config["COMPRESSION_LEVELS"],
+            app.config["COMPRESSION_MIN_SIZE"],
+            app.config["COMPRESSION_MAX_SIZE"],
+        ),
+        exports=exportCache.ExportCache(app.config["EXPORT_CACHE_DIR"]),
+        jobs=jobQueue.JobQueue(
+            mongo,
+            {
+                "upload": app.config["JOB_UPLOAD_WORKERS"],
+                "export": app.config["JOB_EXPORT_WORKERS"],
+            },
+            app.config["JOB_MAX_PENDING"],
+            metrics,
+        ),
+    )
+
+    app.before_request(startRecording)
+    app.after_request(finishRecording)
+    app.teardown_request(stopRecording)
+
+    app.register_blueprint(routes)
+    registerCommands(app)
+    return app
+
+
+def services():
+    """
+    Returns the services of the current app (see create_app).
+    """
+    return current_app.extensions["anemia"]
+
+
+routes = Blueprint("routes", __name__)
+
+
+def startRecording():
+    """
+    Starts recording the stages of the request, and its profile when profiling was asked for.
+    """
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.recording = requestMetrics.start_recording(route, request.method)
+    config = services().config
+    if config["PROFILE_REQUESTS"] and request.args.get("profile") in ("1", "true"):
+        g.profiler = requestMetrics.SamplingProfiler(
+            threading.get_ident(), config["PROFILE_INTERVAL"]
+        ).start()
+
+
+def finishRecording(response):
+    """
+    Adds the request to the metrics and saves its profile, whose file name is sent in the X-Profile header.
+    Streamed responses are measured up to the start of the stream, without a response size.
+    """
+    recording = g.pop("recording", None)
+    if recording is not None:
+        requestMetrics.stop_recording(recording)
+        services().metrics.record(
+            recording,
+            response.status_code,
+            request.content_length,
+            response.content_length,
+        )
+
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        directory = services().config["PROFILE_DIR"]
+        os.makedirs(directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.folded"
+        profiler.stop().write(os.path.join(directory, name))
+        response.headers["X-Profile"] = name
+    return response
+
+
+def stopRecording(error):
+    """
+    Records requests ended by an unhandled error, which skip finishRecording, as failed.
+    """
+    recording = g.pop("recording", None)
+    if recording is not None:
+        requestMetrics.stop_recording(recording)
+        services().metrics.record(recording, 500, request.content_length)
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+
+
+def readListArg(name):
+    """
+    Reads a list parameter given either repeated (?state=A&state=B) or comma separated (?state=A,B).
+    """
+    values = []
+    for value in request.args.getlist(name):
+        values.extend(v.strip() for v in value.split(",") if v.strip())
+    return values or None
+
+
+def readIntArg(name):
+    """
+    Reads an optional integer parameter, raising a ValueError when it is not a number.
+    """
+    value = request.args.get(name)
+    if value is None or value == "":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"Invalid {name} passed")
+
+
+def readDataFilters(type):
+    """
+    Reads the state, district, fields and year/quarter range filters of a data request,
+    raising a ValueError for unknown indicators in fields, or a quarter range on monthly data.
+    """
+    fields = readListArg("fields")
+    if fields:
+        unknown = [f for f in fields if f not in dataAnalytics.indicator_names]
+        if unknown:
+            raise ValueError(f"Invalid indicators passed: {', '.join(unknown)}")
+    quarter_from = request.args.get("quarter_from")
+    quarter_to = request.args.get("quarter_to")
+    if (quarter_from or quarter_to) and type == "monthly":
+        raise ValueError("quarter_from and quarter_to only apply to quarterly data")
+    return {
+        "states": readListArg("state"),
+        "districts": readListArg("district"),
+        "fields": fields,
+        "year_from": readIntArg("year_from"),
+        "year_to": readIntArg("year_to"),
+        "quarter_from": quarter_from,
+        "quarter_to": quarter_to,
+    }
+
+
+@functools.cache
+def dataMediaTypes():
+    """
+    Returns the media types GET / can answer with: JSON, and the Arrow stream when pyarrow is installed,
+    so a client preferring Arrow still gets JSON from a server without it.
+    pyarrow is only looked up here; it is imported once an Arrow response is actually built.
+    """
+    if importlib.util.find_spec("pyarrow") is None:
+        return ["application/json"]
+    return ["application/json", dataAnalytics.arrow_stream_type]
+
+
+def streamStates(type, filters):
+    """
+    Yields the JSON array of states chunk by chunk, serializing each state as the cursor produces it.
+
+    The first state is read before anything is yielded, so errors such as an invalid type are raised
+    by the first next() call, while a proper error response can still be sent.
+    """
+    s = services()
+    states = dbHandling.stream_database(
+        s.mongo, type, batch_size=s.config["STREAM_BATCH_SIZE"], **filters
+    )
+    first = next(states, None)
+    yield "[" + (current_app.json.dumps(first) if first is not None else "")
+    for state in states:
+        yield "," + current_app.json.dumps(state)
+    yield "]"
 
 
 # Route to retrieve data based on the provided 'type' parameter (monthly or quarterly)
-@app.route("/", methods=["GET"])
+# Optional filters: state, district, fields (indicator names), year_from / year_to and quarter_from / quarter_to
+# With stream=true, an uncached response is sent as a chunked JSON array while MongoDB is being read
+# With "Accept: application/vnd.apache.arrow.stream" the data is sent as a columnar Arrow IPC stream instead
+# The data is read on the primary: a lagging secondary could otherwise fill the cache, or the ETag of the
+# new data version, with the data of the previous one
+@routes.route("/", methods=["GET"])
 def getData():
     try:
         type = request.args.get("type")
-        data = dbHandling.read_database(
-            mongo, type
-        )  # Call function to read data from MongoDB
-        return jsonify(data), 201
+        filters = readDataFilters(type)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        s = services()
+        version = s.dataVersion.get(s.mongo)
+        mediaType = request.accept_mimetypes.best_match(
+            dataMediaTypes(), "application/json"
+        )
+        key = (
+            type,
+            version,
+            tuple(
+                (k, tuple(v) if isinstance(v, list) else v) for k, v in filters.items()
+            ),
+            mediaType,
+        )
+        encoding, etag = negotiateEncoding(
+            f"{version}-{hashlib.sha1(repr(key).encode()).hexdigest()[:16]}"
+        )
+        if request.if_none_match.contains(etag):
+            return notModified(etag)
+
+        body = s.responses.get(key)
+        if body is None and mediaType == dataAnalytics.arrow_stream_type:
+            body = responseCompression.CompressedBody(
+                dataAnalytics.columnar_arrow(s.mongo, type, **filters),
+                s.compression,
+            )
+            s.responses.set(key, body)
+        if body is None and request.args.get("stream") in ("1", "true"):
+            chunks = streamStates(type, filters)
+            first_chunk = next(chunks)
+            response = current_app.response_class(
+                stream_with_context(itertools.chain([first_chunk], chunks)),
+                status=201,
+                mimetype="application/json",
+            )
+            response.set_etag(etag)
+            response.vary.update(["Accept", "Accept-Encoding"])
+            return response
+        if body is None:
+            data = dbHandling.read_database(
+                s.mongo, type, **filters
+            )  # Call function to read data from MongoDB
+            with requestMetrics.stage("serialize"):
+                body = responseCompression.CompressedBody(
+                    current_app.json.dumps(data), s.compression
+                )
+            s.responses.set(key, body)
+
+        return bodyResponse(body, encoding, etag, 201, mediaType)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
+        current_app.logger.exception(e)
         return jsonify({"error": str(e)}), 500
 
 
+def negotiateEncoding(etag):
+    """
+    Returns the Content-Encoding negotiated for the request (None for none) and the ETag of its representation.
+    """
+    encoding = services().compression.negotiate(request.accept_encodings)
+    return encoding, f"{etag}-{encoding}" if encoding else etag
+
+
+def notModified(etag):
+    return "", 304, {"ETag": f'"{etag}"', "Vary": "Accept, Accept-Encoding"}
+
+
+def bodyResponse(body, encoding, etag, status, mimetype="application/json"):
+    """
+    Returns the response of a cached body, compressed with the negotiated encoding.
+    """
+    with requestMetrics.stage("compress"):
+        data, contentEncoding = body.encoded(encoding)
+    response = current_app.response_class(data, status=status, mimetype=mimetype)
+    if contentEncoding:
+        response.headers["Content-Encoding"] = contentEncoding
+    response.vary.update(["Accept", "Accept-Encoding"])
+    response.set_etag(etag)
+    return response
+
+
+def tokenRequired(route):
+    """
+    Rejects requests without a valid session token ("Authorization: Bearer <token>") when REQUIRE_TOKEN is set.
+    Verifying a token is a single HMAC check, without any database query.
+    """
+
+    @functools.wraps(route)
+    def wrapper(*args, **kwargs):
+        s = services()
+        if s.config["REQUIRE_TOKEN"]:
+            header = request.headers.get("Authorization", "")
+            token = header[7:] if header.startswith("Bearer ") else None
+            if not token or s.tokens.verify(token) is None:
+                return jsonify({"error": "Invalid or missing token"}), 401
+        return route(*args, **kwargs)
+
+    return wrapper
+
+
 # Route for user login
-@app.route("/login", methods=["POST"])
+@routes.route("/login", methods=["POST"])
 def loginUser():
+    s = services()
     loggedIn = dbHandling.login_user(
-        mongo, bcrypt, request.json
+        s.mongo, s.bcrypt, request.json
     )  # Call function to validate user login
     if loggedIn == "Invalid Password":
         return jsonify({"error": "Invalid password"}), 401
     elif loggedIn == "User Logged In Successfully":
-        return jsonify({"success": "User logged in successfully"}), 201
+        token = s.tokens.issue(request.json["userName"])  # Issue a session token
+        return jsonify({"success": "User logged in successfully", "token": token}), 201
     elif loggedIn == "User Not Found":
         return jsonify({"error": "User not found"}), 404
     else:
@@ -52,10 +372,11 @@ def loginUser():
 
 
 # Route for user registration
-@app.route("/register", methods=["POST"])
+@routes.route("/register", methods=["POST"])
 def registerUser():
+    s = services()
     registered = dbHandling.register_user(
-        mongo, bcrypt, request.json
+        s.mongo, s.bcrypt, request.json
     )  # Call function to register a new user
     if registered == "success":
         return jsonify({"success": "SUCCESS"}), 201
@@ -65,8 +386,59 @@ def registerUser():
         return jsonify({"error": "Error connecting to database"}), 400
 
 
+def ingestUpload(s, stream, type, period=None):
+    """
+    Adds the rows of an uploaded CSV stream to MongoDB and, on success, bumps the data version
+    and schedules the exports of the new version. A file whose content was already uploaded is skipped.
+    """
+    fingerprint = dataProcessing.file_fingerprint(stream)  # Hash the file content
+    records = dataProcessing.iter_csv_records(stream)  # Stream the CSV rows as records
+    result = dbHandling.add_to_database(
+        s.mongo,
+        records,
+        type,
+        period=period,
+        fingerprint=fingerprint,
+        claim_timeout=s.config["UPLOAD_CLAIM_TIMEOUT"],
+    )  # Add data to MongoDB
+    if result["status"] == "SUCCESS":
+        version = s.dataVersion.bump(s.mongo)  # Invalidate the cached responses
+        for format in s.config["EXPORT_PREBUILD_FORMATS"]:
+            for exportType in ("monthly", "quarterly"):
+                scheduleExport(
+                    s, version, format.strip(), exportType
+                )  # Prepare the next downloads
+    return result
+
+
+def uploadJob(s, path, type, period=None):
+    """
+    Background job ingesting an upload saved to a temporary file, which is removed afterwards.
+    """
+    try:
+        with open(path, "rb") as stream:
+            result = ingestUpload(s, stream, type, period)
+    finally:
+        os.remove(path)
+    if result["status"] == "IN_PROGRESS":
+        raise Exception("The same file is being uploaded, try again later")
+    if result["status"] not in ("SUCCESS", "DUPLICATE"):
+        raise Exception(result["status"])
+    return result
+
+
+def isAsync():
+    """
+    Tells whether the request asked to be run as a background job (async=true).
+    """
+    return request.values.get("async") in ("1", "true")
+
+
 # Route to receive and process uploaded CSV files
-@app.route("/upload", methods=["POST"])
+# With async=true the file is processed as a background job and a job id is returned right away
+# With period=<year>_<month or quarter> (e.g. 2022_3 or 2022_I) the file replaces that period instead of adding the next one
+@routes.route("/upload", methods=["POST"])
+@tokenRequired
 def receiveFile():
     if "csvFile" not in request.files:
         return jsonify({"error": "No file part"}), 404
@@ -75,28 +447,358 @@ def receiveFile():
     if receivedFile.filename == "":
         return "No selected file", 401
 
+    s = services()
     type = request.form["type"]
-    json_data = dataProcessing.process_csv_to_json(receivedFile)  # Convert CSV to JSON
-    if json_data:
-        dbHandling.add_to_database(
-            mongo, json.loads(json_data), type
-        )  # Add data to MongoDB
-        return jsonify({"status": "SUCCESS"}), 200
+    period = None
+    try:
+        if request.form.get("period"):
+            period = dbHandling.parse_period(request.form["period"], type)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if isAsync():
+        if type not in ("monthly", "quarterly"):
+            return jsonify({"error": "Invalid type passed"}), 400
+        with tempfile.NamedTemporaryFile(suffix=".csv", delete=False) as saved:
+            receivedFile.save(saved)
+        try:
+            jobId = s.jobs.submit("upload", uploadJob, s, saved.name, type, period)
+        except jobQueue.JobQueueFull as e:
+            os.remove(saved.name)
+            return jsonify({"error": str(e)}), 503
+        return jsonify({"jobId": jobId}), 202
+
+    try:
+        result = ingestUpload(s, receivedFile.stream, type, period)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if result["status"] in ("SUCCESS", "DUPLICATE"):
+        return jsonify(result), 200
+    elif result["status"] == "IN_PROGRESS":
+        return (
+            jsonify({"error": "The same file is being uploaded, try again later"}),
+            409,
+        )
+    elif result["status"] == "MongoDB Error":
+        return jsonify({"error": "Error connecting to database"}), 500
     else:
         return jsonify({"error": "JSON not formatted properly, try again"}), 400
 
 
-# Route to download data in Excel format
-@app.route("/download", methods=["GET"])
+def exportBuilder(mongo, format, type, filters=None):
+    """
+    Returns the function writing the export in the provided format, as expected by the export cache.
+    """
+    return lambda output: dataExtractor.exportData(
+        mongo, output, format, type, **(filters or {})
+    )
+
+
+def exportFilename(format, type):
+    """
+    Returns the download name of an export, e.g. output.xlsx or output-quarterly.xlsx.
+    """
+    filename = dataExtractor.export_formats[format][0]
+    return filename if type == "monthly" else filename.replace(".", f"-{type}.", 1)
+
+
+def scheduleExport(s, version, format, type):
+    """
+    Builds the export of the version in the provided format and type in the background.
+    """
+    s.exports.schedule(
+        version, exportFilename(format, type), exportBuilder(s.mongo, format, type)
+    )
+
+
+def readExportFilters():
+    """
+    Reads the state, district, year range and indicators filters of an export request.
+    """
+    filters = {
+        "states": readListArg("state"),
+        "districts": readListArg("district"),
+        "year_from": readIntArg("year_from"),
+        "year_to": readIntArg("year_to"),
+        "indicators": readListArg("indicators"),
+    }
+    return {k: v for k, v in filters.items() if v is not None}
+
+
+# Route to download data in Excel format, or as CSV, Parquet or Arrow with format=csv|parquet|arrow
+# type=quarterly exports the quarterly data instead of the monthly data
+# Optional filters: state, district, year_from / year_to and indicators (export column names)
+# The full export is served from the export cache, with ETag (per format, type and data version) and Range support;
+# a cold cache builds it on demand
+# CSV and Arrow exports are sent compressed when the client accepts it, from a compressed copy kept next to the file
+# Filtered exports are built on demand from the matching buckets only, read with MONGO_READ_PREFERENCE;
+# the cached full exports are read on the primary, like GET /
+# With async=true the export is built as a background job and a job id is returned right away
+@routes.route("/download", methods=["GET"])
 def exportFile():
+    format = request.args.get("format", "xlsx")
+    if format not in dataExtractor.export_formats:
+        return jsonify({"error": "Invalid format passed"}), 400
+    type = request.args.get("type", "monthly")
+    if type not in dataExtractor.period_labels:
+        return jsonify({"error": "Invalid type passed"}), 400
+    _, mimetype, _ = dataExtractor.export_formats[format]
+    filename = exportFilename(format, type)
+
     try:
-        data = dataExtractor.read_database(mongo)  # Retrieve data from MongoDB
-        response = dataExtractor.modifyToExcel(data)  # Modify data and export to Excel
-        return response, 201
+        s = services()
+        filters = readExportFilters()
+        if format in ("parquet", "arrow"):
+            dataExtractor.requirePyarrow(format)
+        if isAsync():
+            jobId = s.jobs.submit("export", exportJob, s, format, type, filters)
+            return jsonify({"jobId": jobId}), 202
+        if filters:
+            frame = dataExtractor.readExportFrame(s.mongo.reads, type, **filters)
+            return dataExtractor.sendExport(frame, format, filename)
+
+        version = s.dataVersion.get(s.mongo)
+        path = s.exports.get(version, filename, exportBuilder(s.mongo, format, type))
+        encoding = None
+        if format in dataExtractor.compressible_formats:
+            encoding = s.compression.negotiate(request.accept_encodings)
+        if encoding and s.compression.worth_compressing(os.path.getsize(path)):
+            with requestMetrics.stage("compress"):
+                path = s.compression.compress_file(path, encoding)
+        else:
+            encoding = None
+        response = send_file(
+            path,
+            mimetype=mimetype,
+            as_attachment=True,
+            download_name=filename,
+            conditional=True,
+            etag=f"{format}-{type}-{version}" + (f"-{encoding}" if encoding else ""),
+        )
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        return response
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except jobQueue.JobQueueFull as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
+        current_app.logger.exception(e)
         return jsonify({"error": str(e)}), 500
 
 
+def exportJob(s, format, type, filters):
+    """
+    Background job building an export into the export cache. Filtered exports are stored under
+    a name of their own, and like every export they are removed once a newer data version is built.
+    """
+    version = s.dataVersion.get(s.mongo)
+    filename = exportFilename(format, type)
+    cachedName = filename
+    if filters:
+        cachedName = f"{uuid.uuid4().hex}-{filename}"
+    path = s.exports.get(
+        version,
+        cachedName,
+        exportBuilder(s.mongo.reads if filters else s.mongo, format, type, filters),
+    )
+    return {"path": path, "filename": filename, "format": format, "version": version}
+
+
+# Route to compute a summary of the data on the server: means, trends, top (districts) or movers (rank changes)
+# Takes the filters of GET / (fields naming the indicators of means and trends), plus level=state|district
+# for means and trends, indicator, k and order=desc|asc for top and k for movers
+# Reports are cached per data version like GET / responses
+@routes.route("/analytics/<report>", methods=["GET"])
+def getAnalytics(report):
+    if report not in dataAnalytics.reports:
+        return jsonify({"error": "Invalid report passed"}), 404
+    try:
+        type = request.args.get("type")
+        filters = readDataFilters(type)
+        indicators = filters.pop("fields")
+        options = {
+            "level": request.args.get("level"),
+            "indicator": request.args.get("indicator"),
+            "k": readIntArg("k"),
+            "order": request.args.get("order"),
+        }
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return versionedJson(
+        ("analytics", report),
+        lambda mongo: dataAnalytics.run_report(
+            mongo, report, type, filters, indicators, **options
+        ),
+    )
+
+
+# Route to read the rollups of every period: per-state or national (without state) indicator means,
+# minimums, maximums and district counts, kept up to date by every upload
+# Optional filters: state and year_from / year_to
+@routes.route("/rollups", methods=["GET"])
+def getRollups():
+    try:
+        type = request.args.get("type")
+        filters = {
+            "states": readListArg("state"),
+            "year_from": readIntArg("year_from"),
+            "year_to": readIntArg("year_to"),
+        }
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return versionedJson(
+        ("rollups",),
+        lambda mongo: dbHandling.read_rollups(mongo, type, **filters),
+    )
+
+
+def versionedJson(name, build):
+    """
+    Returns the JSON response built by build(mongo) for the request, from the response cache when possible.
+    Responses are cached and given an ETag per data version and query string, like GET / responses.
+    """
+    try:
+        s = services()
+        version = s.dataVersion.get(s.mongo)
+        key = name + (version, tuple(sorted(request.args.items(multi=True))))
+        encoding, etag = negotiateEncoding(
+            f"{version}-{hashlib.sha1(repr(key).encode()).hexdigest()[:16]}"
+        )
+        if request.if_none_match.contains(etag):
+            return notModified(etag)
+
+        body = s.responses.get(key)
+        if body is None:
+            data = build(s.mongo)
+            with requestMetrics.stage("serialize"):
+                body = responseCompression.CompressedBody(
+                    current_app.json.dumps(data), s.compression
+                )
+            s.responses.set(key, body)
+
+        return bodyResponse(body, encoding, etag, 200)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        current_app.logger.exception(e)
+        return jsonify({"error": str(e)}), 500
+
+
+# Route to check the status of a background job
+@routes.route("/jobs/<jobId>", methods=["GET"])
+def jobStatus(jobId):
+    job = dbHandling.read_job(services().mongo, jobId)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    status = {
+        "jobId": job["_id"],
+        "type": job["type"],
+        "status": job["status"],
+        "createdAt": job["createdAt"].isoformat(),
+        "updatedAt": job["updatedAt"].isoformat(),
+    }
+    if "error" in job:
+        status["error"] = job["error"]
+    if job["type"] == "upload" and "result" in job:
+        status["result"] = job["result"]
+    return jsonify(status), 200
+
+
+# Route to fetch the result of a finished background job: the upload summary or the export file
+@routes.route("/jobs/<jobId>/result", methods=["GET"])
+def jobResult(jobId):
+    job = dbHandling.read_job(services().mongo, jobId)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    if job["status"] == "failed":
+        return jsonify({"error": job.get("error", "Job failed")}), 500
+    if job["status"] != "done":
+        return jsonify({"status": job["status"]}), 409
+    if job["type"] == "upload":
+        return jsonify(job["result"]), 200
+
+    result = job["result"]
+    if not os.path.exists(result["path"]):
+        return jsonify({"error": "Export expired, request it again"}), 410
+    return send_file(
+        result["path"],
+        mimetype=dataExtractor.export_formats[result["format"]][1],
+        as_attachment=True,
+        download_name=result["filename"],
+        conditional=True,
+    )
+
+
+# Route exposing the request, stage, document count and payload size histograms of the worker to Prometheus
+@routes.route("/metrics", methods=["GET"])
+def metrics():
+    return current_app.response_class(
+        services().metrics.render(), mimetype="text/plain; version=0.0.4"
+    )
+
+
+# Route to inspect the MongoDB connection pool of the worker serving the request
+@routes.route("/pool", methods=["GET"])
+def poolStats():
+    return jsonify(services().mongo.pool_stats()), 200
+
+
+def registerCommands(app):
+    """
+    Registers the maintenance commands of the app on the flask CLI.
+    """
+
+    # Command to move the legacy per-state documents into time buckets: `flask --app app migrate-buckets`
+    @app.cli.command("migrate-buckets")
+    def migrateBuckets():
+        for type in ("monthly", "quarterly"):
+            written = dbHandling.migrate_to_buckets(services().mongo, type)
+            rollups, _ = dbHandling.rebuild_rollups(services().mongo, type)
+            print(f"{type}: {written} buckets written, {rollups} rollups computed")
+
+    # Command to recompute the rollups from the buckets: `flask --app app rebuild-rollups [--check]`
+    # It reports where the stored rollups differ; with --check nothing is written and differences exit with status 1
+    @app.cli.command("rebuild-rollups")
+    @click.option("--check", is_flag=True, help="Only compare the stored rollups.")
+    def rebuildRollups(check):
+        s = services()
+        differences = []
+        for type in ("monthly", "quarterly"):
+            count, found = dbHandling.rebuild_rollups(s.mongo, type, write=not check)
+            print(f"{type}: {count} rollups, {len(found)} differences")
+            for difference in found[:20]:
+                print(f"  {difference}")
+            differences += found
+        if not check:
+            s.dataVersion.bump(s.mongo)  # Invalidate the cached responses
+        elif differences:
+            raise SystemExit(1)
+
+    # Command to create the indexes: `flask --app app ensure-indexes`
+    @app.cli.command("ensure-indexes")
+    def ensureIndexes():
+        for collection, names in dbHandling.ensure_indexes(
+            services().mongo, app.config["JOB_TTL"]
+        ).items():
+            print(f"{collection}: {', '.join(names)}")
+
+    # Command to check that no hot query scans a whole collection: `flask --app app check-query-plans`
+    @app.cli.command("check-query-plans")
+    def checkQueryPlans():
+        failed = False
+        for name, stages, collscan in dbHandling.check_query_plans(services().mongo):
+            print(f"{'COLLSCAN' if collscan else 'ok':<9}{name}: {' > '.join(stages)}")
+            failed = failed or collscan
+        if failed:
+            raise SystemExit(1)
+
+
+# The app served by `gunicorn app:app` and `flask --app app`
+app = create_app()
+
 # Uncomment the following block to run the app locally
 # if __name__ == "__main__":
 #     app.run(debug=True, host="0.0.0.0")
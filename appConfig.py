@@ -0,0 +1,117 @@
+import logging
+import os
+import tempfile
+
+from dotenv import load_dotenv
+
+import dbHandling
+import mongoConnection
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables from a .env file
+load_dotenv()
+
+
+def envFlag(name, default):
+    return os.getenv(name, default).lower() == "true"
+
+
+def defaultConfig():
+    """
+    Returns the app configuration read from the environment, with the defaults of every setting.
+    """
+    return {
+        # MongoDB connection and pool, see mongoConnection.MongoConnection
+        "MONGO_URI": os.getenv("MONGO_URI"),
+        "MONGO_MAX_POOL_SIZE": int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+        "MONGO_MIN_POOL_SIZE": int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+        "MONGO_MAX_IDLE_TIME_MS": int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "0")) or None,
+        "MONGO_WAIT_QUEUE_TIMEOUT_MS": int(
+            os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "0")
+        )
+        or None,
+        "MONGO_CONNECT_TIMEOUT_MS": int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "20000")),
+        "MONGO_SOCKET_TIMEOUT_MS": int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "0"))
+        or None,
+        "MONGO_SERVER_SELECTION_TIMEOUT_MS": int(
+            os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "30000")
+        ),
+        "MONGO_COMPRESSORS": os.getenv("MONGO_COMPRESSORS", ""),
+        "MONGO_READ_PREFERENCE": os.getenv(
+            "MONGO_READ_PREFERENCE", "secondaryPreferred"
+        ),
+        "MONGO_MAX_STALENESS_SECONDS": int(
+            os.getenv("MONGO_MAX_STALENESS_SECONDS", "-1")
+        ),
+        # Create the MongoDB indexes when gunicorn starts, once in its master process (see gunicorn.conf.py);
+        # false to skip, e.g. when they are managed elsewhere
+        "ENSURE_INDEXES": envFlag("ENSURE_INDEXES", "true"),
+        "JOB_TTL": int(os.getenv("JOB_TTL", str(7 * 24 * 3600))),
+        # Hash passwords in a dedicated process pool and issue signed session tokens on login
+        "BCRYPT_LOG_ROUNDS": int(os.getenv("BCRYPT_LOG_ROUNDS", "12")),
+        "BCRYPT_WORKERS": int(os.getenv("BCRYPT_WORKERS", "2")),
+        "SECRET_KEY": os.getenv("SECRET_KEY") or os.urandom(32).hex(),
+        "TOKEN_MAX_AGE": int(os.getenv("TOKEN_MAX_AGE", "86400")),
+        "REQUIRE_TOKEN": envFlag("REQUIRE_TOKEN", "false"),
+        # Cache the GET / response bodies per type and data version
+        "CACHE_MAX_ENTRIES": int(os.getenv("CACHE_MAX_ENTRIES", "64")),
+        "CACHE_TTL": float(os.getenv("CACHE_TTL", "300")),
+        "DATA_VERSION_TTL": float(os.getenv("DATA_VERSION_TTL", "5")),
+        # Keep the generated exports on disk per data version, built in the background after each upload
+        "EXPORT_CACHE_DIR": os.getenv(
+            "EXPORT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "anemia-exports")
+        ),
+        # Export formats built right after an upload; the others are built on their first download
+        "EXPORT_PREBUILD_FORMATS": os.getenv("EXPORT_PREBUILD_FORMATS", "xlsx").split(
+            ","
+        ),
+        # Run uploads and exports requested with async=true as background jobs, with limited threads per kind
+        "JOB_UPLOAD_WORKERS": int(os.getenv("JOB_UPLOAD_WORKERS", "1")),
+        "JOB_EXPORT_WORKERS": int(os.getenv("JOB_EXPORT_WORKERS", "2")),
+        "JOB_MAX_PENDING": int(os.getenv("JOB_MAX_PENDING", "8")),
+        # Seconds after which an upload still being processed is considered abandoned and can be retried
+        "UPLOAD_CLAIM_TIMEOUT": int(os.getenv("UPLOAD_CLAIM_TIMEOUT", "600")),
+        # Number of buckets fetched per cursor round trip when GET / streams its response
+        "STREAM_BATCH_SIZE": int(os.getenv("STREAM_BATCH_SIZE", "100")),
+        # Profile the requests made with profile=true, sampling the stack every PROFILE_INTERVAL seconds
+        "PROFILE_REQUESTS": envFlag("PROFILE_REQUESTS", "false"),
+        "PROFILE_INTERVAL": float(os.getenv("PROFILE_INTERVAL", "0.005")),
+        "PROFILE_DIR": os.getenv(
+            "PROFILE_DIR", os.path.join(tempfile.gettempdir(), "anemia-profiles")
+        ),
+        # Content-Encoding of the cached responses and exports, in order of preference; each body is compressed
+        # once per data version and encoding, levels are per encoding, bodies outside the size bounds are sent as is
+        "COMPRESSION_ENCODINGS": [
+            e.strip()
+            for e in os.getenv("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",")
+            if e.strip()
+        ],
+        "COMPRESSION_LEVELS": {
+            "gzip": int(os.getenv("COMPRESSION_LEVEL_GZIP", "6")),
+            "br": int(os.getenv("COMPRESSION_LEVEL_BR", "5")),
+            "zstd": int(os.getenv("COMPRESSION_LEVEL_ZSTD", "10")),
+        },
+        "COMPRESSION_MIN_SIZE": int(os.getenv("COMPRESSION_MIN_SIZE", "1024")),
+        "COMPRESSION_MAX_SIZE": int(os.getenv("COMPRESSION_MAX_SIZE", "0")),
+        # Import pandas, NumPy and openpyxl at startup instead of on the first upload or export
+        "PRELOAD_EXPORT_LIBRARIES": envFlag("PRELOAD_EXPORT_LIBRARIES", "false"),
+    }
+
+
+def bootstrapIndexes(config=None):
+    """
+    Creates the MongoDB indexes unless ENSURE_INDEXES is false. It is run once per deployment by the on_starting
+    hook of gunicorn.conf.py, in the gunicorn master, instead of at the import of every worker.
+    This module doesn't import app, so the master never builds the app its workers load.
+    """
+    settings = dict(defaultConfig(), **(config or {}))
+    if not settings["ENSURE_INDEXES"]:
+        return
+    mongo = mongoConnection.MongoConnection(settings)
+    try:
+        dbHandling.ensure_indexes(mongo, settings["JOB_TTL"])
+    except Exception as e:
+        logger.exception(f"Error creating the indexes: {str(e)}")
+    finally:
+        mongo.close()
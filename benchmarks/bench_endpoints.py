@@ -0,0 +1,372 @@
+"""
+End-to-end benchmark suite of the API: uploads, data reads and exports through the Flask test client.
+
+Synthetic HMIS-shaped CSVs (states x districts, one file per month of every year) are uploaded through
+POST /upload, which exercises dataProcessing and dbHandling.add_to_database, and the first file is uploaded
+again to time the skipping of duplicate uploads. The read scenarios then call GET / (dbHandling.read_database),
+GET / with stream=true and a state filter, and /download in xlsx and csv (dataExtractor.readExportFrame and the
+writers), and GET / as an Arrow stream when pyarrow is installed. The response and export caches are emptied before every request, so each one does the full work.
+The JSON and Arrow encodings of GET / are also compared: size, gzipped size and client parse time.
+At the end, files missing a column or a district are uploaded, and the suite fails when the rollups differ
+from the ones recomputed from the buckets (dbHandling.rebuild_rollups).
+
+The database is mongomock by default (pip install mongomock), or a real MongoDB with --mongo-uri,
+e.g. a local mongod. The database named in the URI is dropped first.
+
+Every scenario is timed --repeat times (uploads: once per file but the last) and reports the latency
+percentiles and the throughput. It is then run once more under tracemalloc for its peak Python memory.
+pandas, NumPy and openpyxl are imported beforehand, so the first upload or export does not pay for it.
+
+The results can be saved with --output, and compared with a saved baseline with --compare. The
+comparison exits with status 1 when a scenario's median latency or peak memory grew by more than
+--tolerance (0.25 = 25%).
+
+Usage:
+    python benchmarks/bench_endpoints.py --states 10 --districts 20 --years 2 --output baseline.json
+    python benchmarks/bench_endpoints.py --states 10 --districts 20 --years 2 --compare baseline.json
+"""
+
+import argparse
+import gzip
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import app as application  # noqa: E402
+import dataProcessing  # noqa: E402
+import exportCache  # noqa: E402
+from dataAnalytics import arrow_stream_type  # noqa: E402
+
+# HMIS headers of the uploaded files, in the order of the CSV columns
+hmis_columns = [c for c in dataProcessing.column_names if c != "Location"]
+
+
+class MockMongo:
+    """
+    mongomock stand-in for mongoConnection.MongoConnection.
+    """
+
+    def __init__(self):
+        import mongomock
+
+        self.db = mongomock.MongoClient().anemiaBenchmark
+        self.reads = self
+
+    def pool_stats(self):
+        return {}
+
+
+def make_csv(states, districts, seed, rank=True):
+    """
+    Returns one month of synthetic data for every district of every state, as an HMIS CSV with a State column.
+    With rank=False the file has no rank column.
+    """
+    columns = hmis_columns if rank else hmis_columns[:-1]
+    lines = [",".join(["State", "Location"] + [f'"{c}"' for c in columns])]
+    for s in range(states):
+        for d in range(districts):
+            values = [f"{(s * 7 + d * 3 + seed + i) % 100 + 0.5:.1f}" for i in range(6)]
+            if rank:
+                values.append(str(d + 1))
+            lines.append(",".join([f"State {s}", f"District {s}-{d}"] + values))
+    return "\n".join(lines) + "\n"
+
+
+def create_bench_app(mongo_uri, export_dir):
+    config = {
+        "EXPORT_CACHE_DIR": export_dir,
+        "EXPORT_PREBUILD_FORMATS": [],
+        "MONGO_READ_PREFERENCE": "primary",
+        "PRELOAD_EXPORT_LIBRARIES": True,
+    }
+    if mongo_uri:
+        config["MONGO_URI"] = mongo_uri
+        flask_app = application.create_app(config)
+        mongo = flask_app.extensions["anemia"].mongo
+        mongo.client.drop_database(mongo.db.name)
+        application.dbHandling.ensure_indexes(mongo)
+    else:
+        config["MONGO_URI"] = "mongodb://localhost:27017/anemiaBenchmark"
+        flask_app = application.create_app(config)
+        services = flask_app.extensions["anemia"]
+        services.mongo = MockMongo()
+        services.jobs.mongo = services.mongo
+    return flask_app
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, peak_bytes, response_bytes):
+    total = sum(latencies)
+    return {
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies) * 1000,
+        "throughput_rps": len(latencies) / total if total else None,
+        "peak_memory_mb": peak_bytes / 2**20,
+        "response_bytes": response_bytes,
+    }
+
+
+def run_request(request, check):
+    start = time.perf_counter()
+    response = request()
+    body = response.get_data()
+    elapsed = time.perf_counter() - start
+    if response.status_code != check:
+        raise SystemExit(
+            f"Unexpected status {response.status_code}: {body[:200].decode(errors='replace')}"
+        )
+    return elapsed, len(body)
+
+
+def traced_peak(request):
+    tracemalloc.start()
+    try:
+        request().get_data()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_suite(args):
+    with tempfile.TemporaryDirectory() as export_dir:
+        flask_app = create_bench_app(args.mongo_uri, export_dir)
+        services = flask_app.extensions["anemia"]
+        client = flask_app.test_client()
+        results = {}
+
+        def upload(text):
+            return lambda: client.post(
+                "/upload",
+                data={
+                    "csvFile": (io.BytesIO(text.encode()), "data.csv"),
+                    "type": "monthly",
+                },
+                content_type="multipart/form-data",
+            )
+
+        # Uploads: one file per month, the last one being run under tracemalloc
+        files = [
+            make_csv(args.states, args.districts, m) for m in range(12 * args.years)
+        ]
+        measured = [run_request(upload(text), 200) for text in files[:-1]]
+        results["upload"] = summarize(
+            [m[0] for m in measured], traced_peak(upload(files[-1])), measured[-1][1]
+        )
+
+        # Uploading a file again, which is recognized by its hash and skipped
+        measured = [run_request(upload(files[0]), 200) for _ in range(args.repeat)]
+        results["upload_duplicate"] = summarize(
+            [m[0] for m in measured], traced_peak(upload(files[0])), measured[-1][1]
+        )
+
+        def uncached(path, headers=None):
+            def request():
+                services.responses.clear()
+                services.exports = exportCache.ExportCache(
+                    tempfile.mkdtemp(dir=export_dir)
+                )
+                return client.get(path, headers=headers)
+
+            return request
+
+        scenarios = {
+            "get_all": ("/?type=monthly", 201, args.repeat, None),
+            "get_state_stream": (
+                "/?type=monthly&state=State%200&stream=true",
+                201,
+                args.repeat,
+                None,
+            ),
+            "download_xlsx": ("/download", 200, args.export_repeat, None),
+            "download_csv": ("/download?format=csv", 200, args.export_repeat, None),
+        }
+        if has_pyarrow():
+            scenarios["get_all_arrow"] = (
+                "/?type=monthly",
+                201,
+                args.repeat,
+                {"Accept": arrow_stream_type},
+            )
+        for name, (path, status, repeat, headers) in scenarios.items():
+            request = uncached(path, headers)
+            measured = [run_request(request, status) for _ in range(repeat)]
+            results[name] = summarize(
+                [m[0] for m in measured], traced_peak(request), measured[-1][1]
+            )
+        wire = compare_wire(client, args.repeat)
+
+        # The rollups updated by the uploads must match the ones recomputed from the buckets,
+        # including after an upload missing a column and one missing a district
+        for text in (
+            make_csv(args.states, args.districts, 1000, rank=False),
+            make_csv(args.states, args.districts - 1, 1001),
+        ):
+            run_request(upload(text), 200)
+        _, differences = application.dbHandling.rebuild_rollups(
+            services.mongo, "monthly", write=False
+        )
+        if differences:
+            raise SystemExit(f"The rollups differ from the buckets: {differences[:10]}")
+        return results, wire
+
+
+def has_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def median_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def compare_wire(client, repeat):
+    """
+    Compares the JSON and Arrow encodings of the whole monthly data of GET /: size, gzipped size,
+    and the time a client takes to parse them (json.loads, or reading the Arrow stream into NumPy arrays).
+    """
+    encodings = {"json": (None, json.loads)}
+    if has_pyarrow():
+        import pyarrow as pa
+
+        def parse_arrow(body):
+            table = pa.ipc.open_stream(body).read_all()
+            return [
+                table.column(name).combine_chunks().flatten().to_numpy()
+                for name in table.column_names[2:]
+            ]
+
+        encodings["arrow"] = ({"Accept": arrow_stream_type}, parse_arrow)
+
+    wire = {}
+    for name, (headers, parse) in encodings.items():
+        body = client.get("/?type=monthly", headers=headers).get_data()
+        wire[name] = {
+            "bytes": len(body),
+            "gzip_bytes": len(gzip.compress(body)),
+            "parse_ms": median_time(lambda: parse(body), repeat) * 1000,
+        }
+    return wire
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(__file__),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the ratio of every scenario to the baseline and returns the regressions over the tolerance.
+    """
+    regressions = []
+    print(f"\n{'scenario':<20}{'p50 ratio':>10}{'memory ratio':>14}")
+    for name, current in results.items():
+        previous = baseline["results"].get(name)
+        if previous is None:
+            continue
+        ratios = {
+            "p50_ms": current["p50_ms"] / previous["p50_ms"],
+            "peak_memory_mb": current["peak_memory_mb"]
+            / max(previous["peak_memory_mb"], 1e-9),
+        }
+        print(f"{name:<20}{ratios['p50_ms']:>10.2f}{ratios['peak_memory_mb']:>14.2f}")
+        for metric, ratio in ratios.items():
+            if ratio > 1 + tolerance:
+                regressions.append(f"{name} {metric}: {ratio:.2f}x the baseline")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--states", type=int, default=10)
+    parser.add_argument("--districts", type=int, default=20)
+    parser.add_argument("--years", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--export-repeat", type=int, default=5)
+    parser.add_argument("--mongo-uri", help="MongoDB to use instead of mongomock")
+    parser.add_argument("--output", help="file the results are written to, as JSON")
+    parser.add_argument("--compare", help="baseline results file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    results, wire = run_suite(args)
+    print(
+        f"{'scenario':<20}{'count':>6}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"
+        f"{'req/s':>10}{'peak MB':>10}{'bytes':>12}"
+    )
+    for name, r in results.items():
+        print(
+            f"{name:<20}{r['count']:>6}{r['p50_ms']:>10.1f}{r['p90_ms']:>10.1f}{r['p99_ms']:>10.1f}"
+            f"{r['throughput_rps']:>10.1f}{r['peak_memory_mb']:>10.1f}{r['response_bytes']:>12}"
+        )
+
+    print(f"\n{'encoding':<10}{'bytes':>12}{'gzip bytes':>12}{'parse ms':>10}")
+    for name, w in wire.items():
+        print(f"{name:<10}{w['bytes']:>12}{w['gzip_bytes']:>12}{w['parse_ms']:>10.2f}")
+
+    report = {
+        "parameters": {
+            "states": args.states,
+            "districts": args.districts,
+            "years": args.years,
+            "repeat": args.repeat,
+            "export_repeat": args.export_repeat,
+            "backend": "mongodb" if args.mongo_uri else "mongomock",
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "commit": git_commit(),
+        },
+        "results": results,
+        "wire": wire,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline["parameters"] != report["parameters"]:
+            print("Warning: the baseline was run with other parameters")
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
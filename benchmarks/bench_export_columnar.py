@@ -0,0 +1,129 @@
+"""
+Benchmark of the /download data preparation: the columnar export frame against the previous formatter.
+
+A synthetic all-India dataset (states x districts x years of monthly buckets) is loaded into mongomock,
+then both paths turn it into the flat Month/Year/State/District/indicator table:
+- legacy: dbHandling.read_database, one {month: value} dict per cell (the former singleCategoryFormatter),
+  row dicts per district and a DataFrame per district concatenated together (the former modifyToExcel);
+- columnar: dataExtractor.readExportFrame.
+Workbook writing is the same for both and is not timed.
+
+Requires mongomock (pip install mongomock).
+
+Usage:
+    python benchmarks/bench_export_columnar.py --states 36 --districts 20 --years 3
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import mongomock
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import dataExtractor  # noqa: E402
+import dbHandling  # noqa: E402
+
+
+class Mongo:
+    def __init__(self):
+        self.db = mongomock.MongoClient().db
+
+
+def load_dataset(mongo, states, districts, years):
+    buckets = []
+    for s in range(states):
+        for d in range(districts):
+            for y in range(years):
+                buckets.append(
+                    {
+                        "state": f"State {s}",
+                        "district": f"District {s}-{d}",
+                        "year": 2021 + y,
+                        "periods": list(range(1, 13)),
+                        "series": {
+                            name: [float((s + d + y + m) % 100) for m in range(12)]
+                            for name in dataExtractor.export_series.values()
+                        },
+                    }
+                )
+    mongo.db.anemiaBucketsMonthly.insert_many(buckets)
+    return len(buckets)
+
+
+def legacy_frame(mongo):
+    month_names = dataExtractor.month_names
+    state_dfs = []
+    for state_data in dbHandling.read_database(mongo, "monthly"):
+        district_dfs = []
+        for district_data in state_data["data"]:
+            formatted = {}
+            for column, series_name in dataExtractor.export_series.items():
+                formatted[column] = [
+                    {
+                        "year": value["year"],
+                        "singleYearData": [
+                            {month_names[i]: v} for i, v in enumerate(value["data"])
+                        ],
+                    }
+                    for value in district_data.get(series_name, [])
+                ]
+            rows = []
+            columns = list(formatted)
+            for years in zip(*(formatted[c] for c in columns)):
+                for i, month in enumerate(month_names):
+                    row = {
+                        "Month": month,
+                        "Year": years[0]["year"],
+                        "District": district_data["District"],
+                    }
+                    for column, value in zip(columns, years):
+                        data = value["singleYearData"]
+                        row[column] = data[i][month] if i < len(data) else None
+                    rows.append(row)
+            df = pd.DataFrame(rows)
+            df["State"] = state_data["state"]
+            district_dfs.append(df)
+        state_dfs.append(pd.concat(district_dfs, ignore_index=True))
+    frame = pd.concat(state_dfs, ignore_index=True)
+    return frame.reindex(columns=dataExtractor.export_columns)
+
+
+def timed(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--states", type=int, default=36)
+    parser.add_argument("--districts", type=int, default=20)
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    mongo = Mongo()
+    bucket_count = load_dataset(mongo, args.states, args.districts, args.years)
+    print(f"{bucket_count} buckets, {bucket_count * 12} export rows")
+
+    legacy_time, legacy = timed(lambda: legacy_frame(mongo), args.repeat)
+    columnar_time, columnar = timed(
+        lambda: dataExtractor.readExportFrame(mongo), args.repeat
+    )
+    assert legacy.shape == columnar.shape, (legacy.shape, columnar.shape)
+
+    print(f"{'legacy':<10}{legacy_time:>10.3f} s")
+    print(f"{'columnar':<10}{columnar_time:>10.3f} s")
+    print(f"speedup   {legacy_time / columnar_time:>10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark of the worker startup: time to import the app and resident memory (RSS) of the process afterwards.
+
+Every run imports app in a fresh Python process, as a gunicorn worker does without --preload, once with
+the default lazy imports and once with PRELOAD_EXPORT_LIBRARIES=true. Importing the app creates no index
+and opens no MongoDB connection, so no database is needed.
+
+The median of the runs is printed for both modes, with the heavy modules loaded at startup. With
+--max-import-ms and/or --max-rss-mb, the script exits with status 1 when the default mode goes over
+them, so regressions (such as a new module-level pandas import) can be caught in CI.
+
+Usage:
+    python benchmarks/bench_startup.py --runs 5 --max-import-ms 500 --max-rss-mb 80
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Run in the child process: imports the app and reports the import time, RSS and loaded heavy modules
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import app
+import_ms = (time.perf_counter() - start) * 1000
+rss_kb = None
+try:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                rss_kb = int(line.split()[1])
+except OSError:
+    import resource
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+import dataExtractor
+print(json.dumps({
+    "import_ms": import_ms,
+    "rss_mb": rss_kb / 1024,
+    "modules": [m for m in dataExtractor.heavy_modules if m in sys.modules],
+}))
+"""
+
+
+def measure(preload, runs):
+    env = dict(
+        os.environ,
+        MONGO_URI=os.environ.get("MONGO_URI", "mongodb://localhost:27017/anemia"),
+        PRELOAD_EXPORT_LIBRARIES="true" if preload else "false",
+    )
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", CHILD],
+            cwd=ROOT,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        "import_ms": statistics.median(r["import_ms"] for r in results),
+        "rss_mb": statistics.median(r["rss_mb"] for r in results),
+        "modules": results[-1]["modules"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float)
+    parser.add_argument("--max-rss-mb", type=float)
+    args = parser.parse_args()
+
+    lazy = measure(False, args.runs)
+    preload = measure(True, args.runs)
+    for name, result in (("lazy", lazy), ("preload", preload)):
+        print(
+            f"{name:<8} import {result['import_ms']:8.1f} ms   RSS {result['rss_mb']:6.1f} MB"
+            f"   heavy modules: {', '.join(result['modules']) or 'none'}"
+        )
+
+    failed = False
+    if args.max_import_ms is not None and lazy["import_ms"] > args.max_import_ms:
+        print(f"import time over {args.max_import_ms} ms")
+        failed = True
+    if args.max_rss_mb is not None and lazy["rss_mb"] > args.max_rss_mb:
+        print(f"RSS over {args.max_rss_mb} MB")
+        failed = True
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Micro-benchmark for the merge step of dbHandling.add_to_database.
+
+It times how long it takes to read the current year's buckets of the uploaded states (dbHandling.find_year_buckets,
+from an in-memory collection) and turn the uploaded rows into bucket updates, for states with a growing number
+of districts and years of history. It compares that with the previous algorithm, which looked up every row's
+district with a linear scan over the state's whole data list and rewrote the state document.
+
+The new merge should cost the same per district and period whatever the size of the state,
+i.e. total upload time grows linearly with districts x periods.
+
+Usage:
+    python benchmarks/bench_upload_merge.py --districts 100 200 400 800 --years 1 5 10
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import dbHandling  # noqa: E402
+
+indicators = [
+    "Children (6 - 59 months)",
+    "Children (6 - 9 years)",
+    "Adolescents (10 - 19 years)",
+    "Pregnant Women",
+    "Mothers",
+    "Index Value",
+    "Rank",
+]
+
+
+def make_rows(districts, seed):
+    return [
+        dict({"District": f"District {d}"}, **{k: float(d + seed) for k in indicators})
+        for d in range(districts)
+    ]
+
+
+def legacy_merge(data, array_of_dictionaries):
+    # The per-row scan and key-by-key rollover of the previous add_to_database (monthly)
+    for item in array_of_dictionaries:
+        matching_object = next(
+            (obj for obj in data if obj.get("District") == item["District"]), None
+        )
+        if matching_object:
+            for key, value in item.items():
+                if key != "District":
+                    if len(matching_object[key][-1]["data"]) < 12:
+                        matching_object[key][-1]["data"].append(value)
+                    else:
+                        new_year = matching_object[key][-1]["year"] + 1
+                        matching_object[key].append({"year": new_year, "data": [value]})
+        else:
+            new_item = {"District": item["District"]}
+            for key, value in item.items():
+                if key != "District":
+                    new_item[key] = [{"year": 2021, "data": [value]}]
+            data.append(new_item)
+    return data
+
+
+class MemoryCollection:
+    """
+    In-memory stand-in for a bucket collection, indexed by state and year like the MongoDB one,
+    that applies the $push / $set / $setOnInsert updates of dbHandling.build_bucket_updates.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+
+    def find(self, query, projection=None):
+        return [
+            bucket
+            for state in query["state"]["$in"]
+            for year in query["year"]["$in"]
+            for bucket in self.buckets.get((state, year), {}).values()
+        ]
+
+    def bulk_write(self, updates):
+        for update in updates:
+            key, document = update._filter, update._doc
+            bucket = self.buckets.setdefault((key["state"], key["year"]), {}).get(
+                key["district"]
+            )
+            if bucket is None:
+                bucket = dict(key, periods=[], series={})
+                bucket.update(document.get("$setOnInsert", {}))
+                self.buckets[(key["state"], key["year"])][key["district"]] = bucket
+            for path, value in document.get("$set", {}).items():
+                bucket["series"][path.split(".", 1)[1]] = value
+            for path, value in document["$push"].items():
+                if path == "periods":
+                    bucket["periods"].append(value)
+                else:
+                    bucket["series"].setdefault(path.split(".", 1)[1], []).append(value)
+
+
+def run(districts, years, legacy):
+    periods = years * 12
+    uploads = [make_rows(districts, p) for p in range(periods)]
+    data = []
+    collection = MemoryCollection()
+    last_period = None
+
+    elapsed = 0.0
+    for rows in uploads:
+        start = time.perf_counter()
+        if legacy:
+            legacy_merge(data, rows)
+            elapsed += time.perf_counter() - start
+            continue
+        # Reading the current year's buckets and building the updates, as add_to_database does
+        year, period = dbHandling.next_period(last_period, "monthly")
+        state_index = dbHandling.index_states(rows)
+        buckets = dbHandling.find_year_buckets(
+            collection, {state: year for state in state_index}
+        )
+        updates = []
+        for state, district_index in state_index.items():
+            updates.extend(
+                dbHandling.build_bucket_updates(
+                    state, district_index, year, period, buckets[state]
+                )
+            )
+        elapsed += time.perf_counter() - start
+        collection.bulk_write(updates)  # MongoDB's share of the work, not timed
+        last_period = (year, period)
+    return elapsed, elapsed / (districts * periods) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--districts", type=int, nargs="+", default=[100, 200, 400, 800]
+    )
+    parser.add_argument("--years", type=int, nargs="+", default=[1, 5])
+    parser.add_argument(
+        "--skip-legacy", action="store_true", help="only time the new merge"
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'algorithm':<10}{'districts':>10}{'years':>7}{'total s':>10}{'us/district-period':>21}"
+    )
+    for years in args.years:
+        for districts in args.districts:
+            for legacy in ([False] if args.skip_legacy else [False, True]):
+                total, per_unit = run(districts, years, legacy)
+                name = "legacy" if legacy else "indexed"
+                print(
+                    f"{name:<10}{districts:>10}{years:>7}{total:>10.3f}{per_unit:>21.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,414 @@
+import dataExtractor
+import dbHandling
+import requestMetrics
+
+# Indicators stored for every district, as named in the database and in GET /
+indicator_names = list(dataExtractor.export_series.values())
+
+
+class DistrictMatrix:
+    """
+    Values of some indicators as one row per district and one column per period of the selected range.
+
+    Missing values are NaN. Rows are sorted by state and district, so the districts of a state are contiguous,
+    and state_starts holds the first row of every state in states.
+    The rows where the district is named after its state (the state totals of the HMIS files) are left out
+    unless read_matrix is asked for them.
+    """
+
+    def __init__(self, type, keys, first_period, values):
+        import numpy as np
+
+        self.type = type
+        self.keys = keys
+        self.first_period = first_period
+        self.values = values
+        self.states = []
+        starts = []
+        for row, (state, _) in enumerate(keys):
+            if not self.states or self.states[-1] != state:
+                self.states.append(state)
+                starts.append(row)
+        self.state_starts = np.array(starts, dtype=np.int64)
+        self.period_count = next(iter(values.values())).shape[1] if values else 0
+
+    def label(self, column):
+        """
+        Returns the label of a column, e.g. "2021_II" for quarterly data or "2021_Jan" for monthly data.
+        """
+        labels = dataExtractor.period_labels[self.type]
+        year, slot = divmod(self.first_period + column, len(labels))
+        return f"{year}_{labels[slot]}"
+
+    def filled_columns(self, indicator):
+        """
+        Returns the first and last columns holding a value of the indicator, or None when it has none.
+        """
+        import numpy as np
+
+        filled = np.flatnonzero(~np.isnan(self.values[indicator]).all(axis=0))
+        if not len(filled):
+            return None
+        return int(filled[0]), int(filled[-1])
+
+    def state_sums(self, values):
+        """
+        Returns the sums of the non-missing values and their counts for every state, per column.
+        """
+        import numpy as np
+
+        present = ~np.isnan(values)
+        sums = np.add.reduceat(np.where(present, values, 0.0), self.state_starts)
+        counts = np.add.reduceat(present.astype(np.int64), self.state_starts)
+        return sums, counts
+
+
+def read_matrix(
+    mongo,
+    type,
+    indicators,
+    states=None,
+    districts=None,
+    year_from=None,
+    year_to=None,
+    quarter_from=None,
+    quarter_to=None,
+    include_state_rows=False,
+):
+    """
+    Reads the requested indicators from the time buckets into a DistrictMatrix.
+
+    The filters are those of dbHandling.find_buckets, applied by MongoDB, and only the requested series are read.
+    Values are placed with one NumPy assignment per indicator, from their row and column positions.
+    The state total rows are only kept with include_state_rows.
+    """
+    import numpy as np
+
+    if type not in dataExtractor.period_labels:
+        raise ValueError("Invalid type passed")
+    labels = dataExtractor.period_labels[type]
+    slots = len(labels)
+    if type == "monthly":
+        slot_of = {month: month - 1 for month in range(1, slots + 1)}
+    else:
+        slot_of = {label: i for i, label in enumerate(labels)}
+
+    with requestMetrics.stage("mongo_read"):
+        buckets = list(
+            dbHandling.find_buckets(
+                mongo,
+                type,
+                states=states,
+                districts=districts,
+                fields=indicators,
+                year_from=year_from,
+                year_to=year_to,
+                quarter_from=quarter_from,
+                quarter_to=quarter_to,
+            )
+        )
+    requestMetrics.count_documents("mongo_read", len(buckets))
+
+    with requestMetrics.stage("reshape"):
+        rows = {}
+        positions = {indicator: ([], [], []) for indicator in indicators}
+        for bucket in buckets:
+            if bucket["district"] == bucket["state"] and not include_state_rows:
+                continue
+            row = rows.setdefault((bucket["state"], bucket["district"]), len(rows))
+            periods = [
+                bucket["year"] * slots + slot_of[period]
+                for period in bucket.get("periods", [])
+            ]
+            series = bucket.get("series", {})
+            for indicator in indicators:
+                row_list, period_list, value_list = positions[indicator]
+                for period, value in zip(periods, series.get(indicator, [])):
+                    if isinstance(value, (int, float)):
+                        row_list.append(row)
+                        period_list.append(period)
+                        value_list.append(value)
+
+        filled = [p for _, period_list, _ in positions.values() for p in period_list]
+        first_period = min(filled) if filled else 0
+        period_count = max(filled) - first_period + 1 if filled else 0
+        values = {}
+        for indicator, (row_list, period_list, value_list) in positions.items():
+            matrix = np.full((len(rows), period_count), np.nan)
+            matrix[
+                np.array(row_list, dtype=np.int64),
+                np.array(period_list, dtype=np.int64) - first_period,
+            ] = np.array(value_list, dtype=float)
+            values[indicator] = matrix
+        return DistrictMatrix(type, list(rows), first_period, values)
+
+
+def rounded(value):
+    """
+    Returns a NumPy value as a float rounded to 4 decimals, or None for NaN.
+    """
+    value = float(value)
+    return None if value != value else round(value, 4)
+
+
+def slopes(values):
+    """
+    Returns the least-squares slope of every row of values against the column index, ignoring missing values.
+    Rows with fewer than two values get NaN.
+    """
+    import numpy as np
+
+    present = ~np.isnan(values)
+    counts = present.sum(axis=1)
+    x = np.where(present, np.arange(values.shape[1], dtype=float), 0.0)
+    y = np.where(present, values, 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x_mean = x.sum(axis=1) / counts
+        y_mean = y.sum(axis=1) / counts
+        x_centered = np.where(present, x - x_mean[:, None], 0.0)
+        covariance = (x_centered * np.where(present, y - y_mean[:, None], 0.0)).sum(
+            axis=1
+        )
+        variance = (x_centered**2).sum(axis=1)
+        return np.where((counts >= 2) & (variance > 0), covariance / variance, np.nan)
+
+
+def range_of(matrix):
+    return {
+        "type": matrix.type,
+        "from": matrix.label(0) if matrix.period_count else None,
+        "to": matrix.label(matrix.period_count - 1) if matrix.period_count else None,
+    }
+
+
+def means_report(matrix, level="state"):
+    """
+    Mean of every indicator over the selected periods, per state (over all its districts) or per district.
+    """
+    import numpy as np
+
+    if level == "district":
+        data = [
+            {"state": state, "district": district} for state, district in matrix.keys
+        ]
+    else:
+        data = [{"state": state} for state in matrix.states]
+    for indicator, values in matrix.values.items():
+        present = ~np.isnan(values)
+        sums = np.where(present, values, 0.0).sum(axis=1)
+        counts = present.sum(axis=1)
+        if level != "district" and len(matrix.keys):
+            sums = np.add.reduceat(sums, matrix.state_starts)
+            counts = np.add.reduceat(counts, matrix.state_starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sums / counts
+        for entry, mean in zip(data, means):
+            entry[indicator] = rounded(mean)
+    return dict(range_of(matrix), level=level, data=data)
+
+
+def trends_report(matrix, level="state"):
+    """
+    Least-squares slope of every indicator over the selected periods, in units per month or per quarter.
+    State slopes are computed on the mean of the state's districts for every period.
+    """
+    import numpy as np
+
+    if level == "district":
+        data = [
+            {"state": state, "district": district} for state, district in matrix.keys
+        ]
+    else:
+        data = [{"state": state} for state in matrix.states]
+    for indicator, values in matrix.values.items():
+        if level != "district" and len(matrix.keys):
+            sums, counts = matrix.state_sums(values)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                values = sums / counts
+        for entry, slope in zip(data, slopes(values)):
+            entry[indicator] = rounded(slope)
+    return dict(range_of(matrix), level=level, data=data)
+
+
+def top_report(matrix, indicator="Index Value", k=10, order="desc"):
+    """
+    The k districts with the highest (order=desc) or lowest (order=asc) value of the indicator
+    in the last period of the range holding a value of it.
+    """
+    import numpy as np
+
+    columns = matrix.filled_columns(indicator)
+    if columns is None:
+        return dict(range_of(matrix), indicator=indicator, period=None, data=[])
+    column = columns[1]
+    values = matrix.values[indicator][:, column]
+    rows = np.flatnonzero(~np.isnan(values))
+    keys = -values[rows] if order == "desc" else values[rows]
+    ordered = rows[np.argsort(keys, kind="stable")]
+    data = [
+        {
+            "state": matrix.keys[row][0],
+            "district": matrix.keys[row][1],
+            indicator: rounded(values[row]),
+        }
+        for row in ordered[:k]
+    ]
+    return dict(
+        range_of(matrix), indicator=indicator, period=matrix.label(column), data=data
+    )
+
+
+def movers_report(matrix, k=10):
+    """
+    The k districts whose rank improved (decreased) the most and the k whose rank declined the most
+    between the first and the last period of the range holding ranks.
+    """
+    import numpy as np
+
+    columns = matrix.filled_columns("Rank")
+    if columns is None:
+        return dict(range_of(matrix), improved=[], declined=[])
+    ranks = matrix.values["Rank"]
+    before, after = ranks[:, columns[0]], ranks[:, columns[1]]
+    change = after - before
+    rows = np.flatnonzero(~np.isnan(change))
+    ordered = rows[np.argsort(change[rows], kind="stable")]
+
+    def entry(row):
+        return {
+            "state": matrix.keys[row][0],
+            "district": matrix.keys[row][1],
+            "from": rounded(before[row]),
+            "to": rounded(after[row]),
+            "change": rounded(change[row]),
+        }
+
+    report = range_of(matrix)
+    report["from"] = matrix.label(columns[0])
+    report["to"] = matrix.label(columns[1])
+    report["improved"] = [entry(row) for row in ordered[:k] if change[row] < 0]
+    report["declined"] = [entry(row) for row in ordered[::-1][:k] if change[row] > 0]
+    return report
+
+
+# Reports served by /analytics/<report>: function, indicators it reads (None: those requested) and options
+reports = {
+    "means": (means_report, None, ["level"]),
+    "trends": (trends_report, None, ["level"]),
+    "top": (top_report, "indicator", ["indicator", "k", "order"]),
+    "movers": (movers_report, ["Rank"], ["k"]),
+}
+
+
+def run_report(mongo, report, type, filters=None, indicators=None, **options):
+    """
+    Reads the data a report needs and computes it.
+
+    Args:
+        mongo: MongoDB instance.
+        report (str): One of the keys of reports.
+        type (str): "monthly" or "quarterly".
+        filters (dict): Filters of dbHandling.find_buckets (states, districts, year and quarter range).
+        indicators (list): Indicators of the means and trends reports, all of them by default.
+        **options: Options of the report: level ("state" or "district") for means and trends,
+            indicator, k and order ("desc" or "asc") for top, k for movers. Other options are ignored.
+
+    Returns:
+        dict: The report, ready to be serialized to JSON.
+
+    Raises:
+        ValueError: If the report, type, an indicator or an option is invalid.
+        Exception: If an error occurs during processing.
+    """
+    if report not in reports:
+        raise ValueError("Invalid report passed")
+    function, needed, accepted = reports[report]
+    options = {
+        name: value
+        for name, value in options.items()
+        if name in accepted and value is not None
+    }
+    if options.get("level", "state") not in ("state", "district"):
+        raise ValueError("Invalid level passed")
+    if options.get("order", "desc") not in ("desc", "asc"):
+        raise ValueError("Invalid order passed")
+    if options.get("k", 1) < 1:
+        raise ValueError("Invalid k passed")
+
+    if needed == "indicator":
+        options.setdefault("indicator", "Index Value")
+        indicators = [options["indicator"]]
+    elif needed is not None:
+        indicators = needed
+    indicators = indicators or indicator_names
+    unknown = [i for i in indicators if i not in indicator_names]
+    if unknown:
+        raise ValueError(f"Invalid indicators passed: {', '.join(unknown)}")
+
+    try:
+        matrix = read_matrix(mongo, type, indicators, **(filters or {}))
+        with requestMetrics.stage("analytics"):
+            return function(matrix, **options)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise Exception(f"Error processing the report: {str(e)}")
+
+
+# Media type of the columnar Arrow encoding of GET /
+arrow_stream_type = "application/vnd.apache.arrow.stream"
+
+
+def columnar_arrow(mongo, type, fields=None, **filters):
+    """
+    Encodes the data of GET / as an Arrow IPC stream, for clients that chart it.
+
+    There is one row per district, with "state" and "district" columns and one float32 column per indicator,
+    holding a fixed-size list of values aligned with the period axis shared by every row. The period labels
+    (e.g. "2021_Jan" or "2021_II") are stored as a JSON list in the "periods" schema metadata, and missing values
+    are NaN. The state total rows are included, like in GET /.
+
+    Args:
+        mongo: MongoDB instance.
+        type (str): "monthly" or "quarterly".
+        fields (list): Indicators to include, all of them by default.
+        **filters: Filters of dbHandling.find_buckets.
+
+    Returns:
+        bytes: The Arrow IPC stream.
+
+    Raises:
+        ValueError: If the type or an indicator is invalid, or pyarrow is not installed.
+    """
+    import json
+    import numpy as np
+
+    pa = dataExtractor.requirePyarrow("arrow")
+    indicators = fields or indicator_names
+    unknown = [i for i in indicators if i not in indicator_names]
+    if unknown:
+        raise ValueError(f"Invalid indicators passed: {', '.join(unknown)}")
+
+    matrix = read_matrix(mongo, type, indicators, include_state_rows=True, **filters)
+    with requestMetrics.stage("encode"):
+        columns = {
+            "state": pa.array([state for state, _ in matrix.keys], pa.string()),
+            "district": pa.array(
+                [district for _, district in matrix.keys], pa.string()
+            ),
+        }
+        for indicator, values in matrix.values.items():
+            if not matrix.period_count:
+                break  # No period holds a value, and Arrow lists can't have a size of 0
+            columns[indicator] = pa.FixedSizeListArray.from_arrays(
+                pa.array(values.astype(np.float32).ravel(), pa.float32()),
+                matrix.period_count,
+            )
+        periods = [matrix.label(column) for column in range(matrix.period_count)]
+        table = pa.table(columns).replace_schema_metadata(
+            {"type": type, "periods": json.dumps(periods)}
+        )
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
@@ -1,9 +1,14 @@
-import pandas as pd
-from flask import make_response
-from io import BytesIO
-import openpyxl
-from openpyxl.worksheet.table import Table, TableStyleInfo
-from openpyxl.styles import Alignment
+import importlib
+import itertools
+import tempfile
+import warnings
+from flask import send_file
+import dbHandling
+import requestMetrics
+
+# NumPy, pandas and openpyxl are imported by the functions using them, on the first upload or export,
+# so that workers only serving GET / and /login start faster and use less memory (see preloadLibraries)
+heavy_modules = ["numpy", "pandas", "openpyxl"]
 
 # List of month names
 month_names = [
@@ -21,343 +26,403 @@ month_names = [
     "Dec",
 ]
 
+# Labels of the periods of a year, and the name of the export column holding them, per type
+period_labels = {"monthly": month_names, "quarterly": dbHandling.quarter_numerals}
+period_columns = {"monthly": "Month", "quarterly": "Quarter"}
+
+# Columns of the exported sheet, in order (the first one is named after the period type)
+export_columns = [
+    "Month",
+    "Year",
+    "State",
+    "District",
+    "Rank",
+    "Index Value",
+    "Children (6 - 59 months)",
+    "Children (6 - 9 years)",
+    "Adolescents",
+    "Pregnant Women",
+    "Mothers",
+]
 
-def singleCategoryFormatter(values, formatted_district_data, catName):
+# Stored series behind every indicator column of the export
+export_series = {
+    "Rank": "Rank",
+    "Index Value": "Index Value",
+    "Children (6 - 59 months)": "Children (6 - 59 months)",
+    "Children (6 - 9 years)": "Children (6 - 9 years)",
+    "Adolescents": "Adolescents (10 - 19 years)",
+    "Pregnant Women": "Pregnant Women",
+    "Mothers": "Mothers",
+}
+
+
+def readExportFrame(
+    mongo,
+    type="monthly",
+    states=None,
+    districts=None,
+    year_from=None,
+    year_to=None,
+    indicators=None,
+):
     """
-    Formats the data for a single category (e.g., index values, mothers values).
+    Reads the monthly or quarterly data from MongoDB straight into a columnar DataFrame for the export.
+
+    The optional filters are pushed down into the MongoDB query and projection (see dbHandling.find_buckets),
+    so only the requested states, districts, years and indicator series are read.
+
+    Every bucket (one state, district and year) becomes one row per period of the year (12 months or 4 quarters),
+    with missing periods left empty. The values of every indicator are gathered into one flat array together
+    with their row positions, computed from the bucket's periods, and placed with a single NumPy assignment,
+    so no per-cell objects are created.
 
     Args:
-        values (list): List of dictionaries containing data for each year.
-        formatted_district_data (dict): Dictionary to store formatted data.
-        catName (str): Name of the category.
+        mongo: MongoDB instance.
+        type (str): "monthly" or "quarterly".
+        states (list): State names to export.
+        districts (list): District names to export.
+        year_from (int): First year to export.
+        year_to (int): Last year to export.
+        indicators (list): Indicator columns to export (keys of export_series).
 
     Returns:
-        dict: Formatted district data.
+        pandas.DataFrame: One row per state, district, year and period, with the columns in export_columns order
+        and the first column named after the period ("Month" or "Quarter").
 
     Raises:
+        ValueError: If the type or an indicator is invalid.
         Exception: If an error occurs during processing.
     """
-    try:
-        for value in values:
-            year = value["year"]
-            monthly_data = value["data"]
+    import numpy as np
+    import pandas as pd
+
+    if type not in period_labels:
+        raise ValueError("Invalid type passed")
+    if indicators:
+        unknown = [i for i in indicators if i not in export_series]
+        if unknown:
+            raise ValueError(f"Invalid indicators passed: {', '.join(unknown)}")
+        selected = {c: s for c, s in export_series.items() if c in indicators}
+    else:
+        selected = export_series
 
-            formatted_index_value = {"year": year, "singleYearData": []}
+    try:
+        with requestMetrics.stage("mongo_read"):
+            buckets = list(
+                dbHandling.find_buckets(
+                    mongo,
+                    type,
+                    states=states,
+                    districts=districts,
+                    fields=list(selected.values()),
+                    year_from=year_from,
+                    year_to=year_to,
+                )
+            )
+        requestMetrics.count_documents("mongo_read", len(buckets))
+        with requestMetrics.stage("reshape"):
+            labels = period_labels[type]
+            slots = len(labels)
+            row_count = len(buckets) * slots
+
+            # Row of every stored value: the bucket's first row plus the slot of its period
+            if type == "monthly":
+                slot_of = {month: month - 1 for month in range(1, slots + 1)}
+            else:
+                slot_of = {label: i for i, label in enumerate(labels)}
+            positions = [
+                [i * slots + slot_of[period] for period in bucket.get("periods", [])]
+                for i, bucket in enumerate(buckets)
+            ]
+
+            columns = {
+                period_columns[type]: np.tile(
+                    np.array(labels, dtype=object), len(buckets)
+                ),
+                "Year": np.repeat(
+                    np.array([bucket["year"] for bucket in buckets], dtype=np.int64),
+                    slots,
+                ),
+                "State": np.repeat(
+                    np.array([bucket["state"] for bucket in buckets], dtype=object),
+                    slots,
+                ),
+                "District": np.repeat(
+                    np.array([bucket["district"] for bucket in buckets], dtype=object),
+                    slots,
+                ),
+            }
+            for column, series_name in selected.items():
+                rows = []
+                stored = []
+                for bucket, bucket_positions in zip(buckets, positions):
+                    series = bucket.get("series", {}).get(series_name)
+                    if series:
+                        count = min(len(series), len(bucket_positions))
+                        rows.extend(bucket_positions[:count])
+                        stored.extend(series[:count])
+                values = np.full(row_count, np.nan)
+                if rows:
+                    values[np.array(rows, dtype=np.int64)] = np.array(
+                        stored, dtype=float
+                    )
+                columns[column] = values
 
-            for i, val in enumerate(monthly_data):
-                month = month_names[i] if i < len(month_names) else f"Month_{i + 1}"
-                formatted_monthly_data = {month: val}
-                formatted_index_value["singleYearData"].append(formatted_monthly_data)
-            formatted_district_data[catName].append(formatted_index_value)
-        return formatted_district_data
+            frame = pd.DataFrame(
+                columns,
+                columns=[period_columns[type]]
+                + [c for c in export_columns[1:] if c in columns],
+            )
 
+            # Columns holding whole numbers only (such as Rank) are exported as integers
+            for column in selected:
+                values = frame[column]
+                present = values.dropna()
+                if len(present) and (present == np.floor(present)).all():
+                    frame[column] = values.astype("Int64")
+        return frame
     except Exception as e:
         raise Exception(f"Error processing the file: {str(e)}")
 
 
-def read_database(mongo):
+def iterFrameRows(frame, chunk_size=10000):
     """
-    Retrieves data from a MongoDB collection based on the provided type parameter.
+    Yields the rows of an export frame as tuples, with missing values as None.
 
-    Args:
-        mongo: MongoDB instance.
+    The frame is converted chunk by chunk, so only chunk_size rows are boxed into Python objects at a time.
 
-    Returns:
-        list: List of formatted data.
-
-    Raises:
-        Exception: If an error occurs during processing.
+    Args:
+        frame (pandas.DataFrame): Export frame, as returned by readExportFrame.
+        chunk_size (int): Number of rows converted at a time.
     """
-    try:
-        # MongoDB collection for monthly anemia data
-        collection = mongo.db.anemiaDataMonthly
-        # Retrieve documents from the collection
-        documents = list(collection.find({}, {"_id": 0}))
-
-        output_data = []
-
-        for state_data in documents:
-            state_name = state_data["state"]
-            districts_data = state_data["data"]
+    for start in range(0, len(frame), chunk_size):
+        chunk = frame.iloc[start : start + chunk_size].astype(object)
+        chunk = chunk.where(chunk.notna(), None)
+        yield from chunk.itertuples(index=False, name=None)
 
-            formatted_state_data = []
 
-            for district_data in districts_data:
-                district_name = district_data["District"]
-                index_values = district_data.get("Index Value", [])
-                rank_values = district_data.get("Rank", [])
-                children6_59_months_values = district_data.get(
-                    "Children (6 - 59 months)", []
-                )
-                children6_9_years_values = district_data.get(
-                    "Children (6 - 9 years)", []
-                )
-                adolescents_10_19_years_values = district_data.get(
-                    "Adolescents (10 - 19 years)", []
-                )
-                pregnant_women_values = district_data.get("Pregnant Women", [])
-                mothers_values = district_data.get("Mothers", [])
-
-                formatted_district_data = {
-                    "district": district_name,
-                    "index_values": [],
-                    "rank_values": [],
-                    "children6_59_months_values": [],
-                    "children6_9_years_values": [],
-                    "adolescents_10_19_years_values": [],
-                    "pregnant_women_values": [],
-                    "mothers_values": [],
-                }
-
-                # Format Index Values
-                formatted_district_data = singleCategoryFormatter(
-                    index_values, formatted_district_data, "index_values"
-                )
+def writeExcel(rows, output, columns=export_columns, sample_size=1000):
+    """
+    Writes the export rows to an Excel workbook using openpyxl's write-only mode,
+    so rows are flushed to disk as they are appended instead of being kept in memory.
 
-                # Format children months
-                formatted_district_data = singleCategoryFormatter(
-                    children6_59_months_values,
-                    formatted_district_data,
-                    "children6_59_months_values",
-                )
+    Column widths must be set before the first row is written, so they are estimated from
+    the first sample_size rows. Cell styles are built once per column and shared by all its cells.
 
-                # Format children years
-                formatted_district_data = singleCategoryFormatter(
-                    children6_9_years_values,
-                    formatted_district_data,
-                    "children6_9_years_values",
-                )
+    Args:
+        rows (iterable): Rows in the order of columns.
+        output: Binary file-like object the workbook is saved to.
+        columns (list): Column names, written as the header row.
+        sample_size (int): Number of rows used to estimate the column widths.
+    """
+    import openpyxl
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.worksheet.filters import AutoFilter
+    from openpyxl.worksheet.table import Table, TableColumn, TableStyleInfo
+    from openpyxl.styles import Alignment, Font
+
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet("Sheet1")
+
+    rows = iter(rows)
+    sample = list(itertools.islice(rows, sample_size))
+    for col_num, column in enumerate(columns):
+        max_length = max(
+            [len(column)]
+            + [len(str(row[col_num])) for row in sample if row[col_num] is not None]
+        )
+        column_letter = openpyxl.utils.get_column_letter(col_num + 1)
+        worksheet.column_dimensions[column_letter].width = max_length + 2
+
+    header = []
+    for column in columns:
+        cell = WriteOnlyCell(worksheet, value=column)
+        cell.font = Font(bold=True)
+        cell.alignment = Alignment(horizontal="center")
+        header.append(cell)
+    worksheet.append(header)
+
+    # One styled template per column; its style is shared by every cell of the column
+    templates = []
+    for column in columns:
+        template = WriteOnlyCell(worksheet)
+        template.alignment = Alignment(horizontal="center")
+        templates.append(template)
+
+    row_count = 0
+    for row in itertools.chain(sample, rows):
+        cells = []
+        for template, value in zip(templates, row):
+            cell = WriteOnlyCell(worksheet, value=value)
+            cell._style = template._style
+            cells.append(cell)
+        worksheet.append(cells)
+        row_count += 1
+
+    if row_count:
+        table_range = (
+            f"A1:{openpyxl.utils.get_column_letter(len(columns))}{row_count + 1}"
+        )
+        table = Table(displayName="MyTable", ref=table_range)
+        # Write-only worksheets can't read the header back, so the table columns are declared here
+        table.autoFilter = AutoFilter(ref=table_range)
+        table.tableColumns = [
+            TableColumn(id=i + 1, name=column) for i, column in enumerate(columns)
+        ]
+        table.tableStyleInfo = TableStyleInfo(
+            name="TableStyleMedium9",
+            showFirstColumn=False,
+            showLastColumn=False,
+            showRowStripes=True,
+            showColumnStripes=True,
+        )
+        with warnings.catch_warnings():
+            # openpyxl always warns about the manual columns in write-only mode
+            warnings.simplefilter("ignore", UserWarning)
+            worksheet.add_table(table)
 
-                # Format adolescents years
-                formatted_district_data = singleCategoryFormatter(
-                    adolescents_10_19_years_values,
-                    formatted_district_data,
-                    "adolescents_10_19_years_values",
-                )
+    workbook.save(output)
 
-                # Format pregnant women
-                formatted_district_data = singleCategoryFormatter(
-                    pregnant_women_values,
-                    formatted_district_data,
-                    "pregnant_women_values",
-                )
 
-                # Format mothers
-                formatted_district_data = singleCategoryFormatter(
-                    mothers_values,
-                    formatted_district_data,
-                    "mothers_values",
-                )
+def writeCsv(frame, output, chunk_size=10000):
+    """
+    Writes an export frame to output as CSV, chunk_size rows at a time.
+    """
+    frame.to_csv(output, index=False, chunksize=chunk_size, encoding="utf-8")
 
-                # Format state rank
-                formatted_district_data = singleCategoryFormatter(
-                    rank_values,
-                    formatted_district_data,
-                    "rank_values",
-                )
 
-                formatted_state_data.append(formatted_district_data)
-            output_data.append(
-                {"state": state_name, "districtsData": formatted_state_data}
-            )
-        return output_data
-    except Exception as e:
-        raise Exception(f"Error processing the file: {str(e)}")
+def writeParquet(frame, output):
+    """
+    Writes an export frame to output as a Parquet file. Requires pyarrow.
+    """
+    requirePyarrow("parquet")
+    frame.to_parquet(output, index=False)
 
 
-def modifyToExcel(data):
+def writeArrow(frame, output):
+    """
+    Writes an export frame to output as an Arrow IPC file. Requires pyarrow.
     """
-    Modifies the provided data and exports it to an Excel file.
+    pa = requirePyarrow("arrow")
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    with pa.ipc.new_file(output, table.schema) as writer:
+        writer.write_table(table)
 
-    Args:
-        data (list): List of formatted data.
 
-    Returns:
-        flask.Response: Excel file as a Flask response.
+def requirePyarrow(format):
+    """
+    Imports pyarrow, which is only needed for the Parquet and Arrow exports.
 
     Raises:
-        Exception: If an error occurs during processing.
+        ValueError: If pyarrow is not installed.
     """
     try:
-        state_dfs = []
-        for state_data in data:
-            state_name = state_data["state"]
-            year_dfs = []
+        import pyarrow as pa
+        import pyarrow.ipc  # noqa: F401
+    except ImportError:
+        raise ValueError(f"The {format} format requires pyarrow to be installed")
+    return pa
 
-            for district_data in state_data["districtsData"]:
-                district_name = district_data["district"]
 
-                rows = []
-                for (
-                    index_value,
-                    mothers_value,
-                    children_months_value,
-                    children_years_value,
-                    adolescents_value,
-                    pregnant_women_value,
-                    rank_value,
-                ) in zip(
-                    district_data["index_values"],
-                    district_data["mothers_values"],
-                    district_data["children6_59_months_values"],
-                    district_data["children6_9_years_values"],
-                    district_data["adolescents_10_19_years_values"],
-                    district_data["pregnant_women_values"],
-                    district_data["rank_values"],
-                ):
-                    year = index_value["year"]
-                    index_value_data = index_value["singleYearData"]
-                    mothers_data = mothers_value["singleYearData"]
-                    children_months_data = children_months_value["singleYearData"]
-                    children_years_data = children_years_value["singleYearData"]
-                    adolescents_data = adolescents_value["singleYearData"]
-                    pregnant_women_data = pregnant_women_value["singleYearData"]
-                    rank_data = rank_value["singleYearData"]
-
-                    for i, month in enumerate(month_names):
-                        index_value = (
-                            index_value_data[i] if i < len(index_value_data) else None
-                        )
-                        mothers_value = (
-                            mothers_data[i] if i < len(mothers_data) else None
-                        )
-
-                        children_month_value = (
-                            children_months_data[i]
-                            if i < len(children_months_data)
-                            else None
-                        )
-                        children_year_value = (
-                            children_years_data[i]
-                            if i < len(children_years_data)
-                            else None
-                        )
-                        adolescent_value = (
-                            adolescents_data[i] if i < len(adolescents_data) else None
-                        )
-                        pregnant_woman_value = (
-                            pregnant_women_data[i]
-                            if i < len(pregnant_women_data)
-                            else None
-                        )
-                        ranks_value = rank_data[i] if i < len(rank_data) else None
-
-                        rows.append(
-                            {
-                                "Month": month,
-                                "Year": year,
-                                "District": district_name,
-                                "Index Value": index_value[month]
-                                if index_value
-                                else None,
-                                "Mothers": mothers_value[month]
-                                if mothers_value
-                                else None,
-                                "Children (6 - 59 months)": children_month_value[month]
-                                if children_month_value
-                                else None,
-                                "Children (6 - 9 years)": children_year_value[month]
-                                if children_year_value
-                                else None,
-                                "Adolescents": adolescent_value[month]
-                                if adolescent_value
-                                else None,
-                                "Pregnant Women": pregnant_woman_value[month]
-                                if pregnant_woman_value
-                                else None,
-                                "Rank": ranks_value[month] if ranks_value else None,
-                            }
-                        )
-
-                df = pd.DataFrame(rows)
-                year_dfs.append(df)
-
-            for df in year_dfs:
-                df["State"] = state_name
-
-            state_df = pd.concat(year_dfs, ignore_index=True)
-            state_dfs.append(state_df)
-
-        final_df = pd.concat(state_dfs, ignore_index=True)
-        columns_to_keep = [
-            "Month",
-            "Year",
-            "State",
-            "District",
-            "Index Value",
-            "Mothers",
-            "Children (6 - 59 months)",
-            "Children (6 - 9 years)",
-            "Adolescents",
-            "Pregnant Women",
-            "Rank",
-        ]
-        final_df = final_df[columns_to_keep]
-
-        column_order = [
-            "Month",
-            "Year",
-            "State",
-            "District",
-            "Rank",
-            "Index Value",
-            "Children (6 - 59 months)",
-            "Children (6 - 9 years)",
-            "Adolescents",
-            "Pregnant Women",
-            "Mothers",
-        ]
-        final_df = final_df.reindex(columns=column_order, fill_value=None)
+def preloadLibraries():
+    """
+    Imports the libraries of the uploads and exports right away. With `gunicorn --preload`, doing it in the
+    master process lets the workers share these modules instead of each importing them on first use.
+    """
+    for module in heavy_modules:
+        importlib.import_module(module)
 
-        excel_output = BytesIO()
 
-        with pd.ExcelWriter(excel_output, engine="openpyxl") as writer:
-            final_df.to_excel(writer, index=False, sheet_name="Sheet1")
+# Export formats served by /download: file name, MIME type and writer taking (frame, output)
+export_formats = {
+    "xlsx": (
+        "output.xlsx",
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        lambda frame, output: writeExcel(
+            iterFrameRows(frame), output, list(frame.columns)
+        ),
+    ),
+    "csv": ("output.csv", "text/csv", writeCsv),
+    "parquet": ("output.parquet", "application/vnd.apache.parquet", writeParquet),
+    "arrow": ("output.arrow", "application/vnd.apache.arrow.file", writeArrow),
+}
 
-            worksheet = writer.sheets["Sheet1"]
 
-            (max_row, max_col) = final_df.shape
+# Export formats sent compressed when the client accepts it (xlsx and Parquet files are compressed already)
+compressible_formats = {"csv", "arrow"}
 
-            table_range = f"A1:{openpyxl.utils.get_column_letter(max_col)}{max_row}"
 
-            table = Table(displayName="MyTable", ref=table_range)
-            style = TableStyleInfo(
-                name="TableStyleMedium9",
-                showFirstColumn=False,
-                showLastColumn=False,
-                showRowStripes=True,
-                showColumnStripes=True,
-            )
-            table.tableStyleInfo = style
-            worksheet.add_table(table)
+def exportData(mongo, output, format="xlsx", type="monthly", **filters):
+    """
+    Reads the monthly or quarterly data from MongoDB and writes the export to output in the provided format.
 
-            for row_num in range(1, max_row + 1):
-                for col_num in range(max_col):
-                    cell_coord = openpyxl.utils.get_column_letter(col_num + 1) + str(
-                        row_num + 1
-                    )
-                    worksheet[cell_coord].alignment = Alignment(horizontal="center")
+    Args:
+        mongo: MongoDB instance.
+        output: Binary file-like object the export is written to.
+        format (str): One of the keys of export_formats.
+        type (str): "monthly" or "quarterly".
+        **filters: Filters passed to readExportFrame.
 
-            for col_num, value in enumerate(final_df.columns.values):
-                column_letter = openpyxl.utils.get_column_letter(col_num + 1)
-                max_length = max(
-                    final_df[value].astype(str).apply(len).max(), len(value)
-                )
-                adjusted_width = max_length + 2
-                worksheet.column_dimensions[column_letter].width = adjusted_width
+    Raises:
+        ValueError: If the format is unknown or its dependencies are missing.
+    """
+    if format not in export_formats:
+        raise ValueError("Invalid format passed")
+    if format in ("parquet", "arrow"):
+        requirePyarrow(format)
+    frame = readExportFrame(mongo, type, **filters)
+    with requestMetrics.stage(f"write_{format}"):
+        export_formats[format][2](frame, output)
+
+
+def sendExport(frame, format="xlsx", filename=None):
+    """
+    Exports the provided export frame in the provided format and sends it as a download.
+
+    The file is written to a temporary file rather than memory, and the response
+    streams that file to the client in chunks.
 
-        excel_output.seek(0)
+    Args:
+        frame (pandas.DataFrame): Export frame, as returned by readExportFrame.
+        format (str): One of the keys of export_formats.
+        filename (str): Download name, defaulting to the format's file name.
 
-        response = make_response(excel_output.read())
-        response.headers["Content-Disposition"] = "attachment; filename=output.xlsx"
-        response.headers[
-            "Content-Type"
-        ] = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    Returns:
+        flask.Response: Export file as a Flask response.
 
-        return response
+    Raises:
+        Exception: If an error occurs during processing.
+    """
+    try:
+        default_filename, mimetype, writer = export_formats[format]
+        output = tempfile.TemporaryFile()
+        with requestMetrics.stage(f"write_{format}"):
+            writer(frame, output)
+        output.seek(0)
+
+        return send_file(
+            output,
+            mimetype=mimetype,
+            as_attachment=True,
+            download_name=filename or default_filename,
+        )
 
     except Exception as e:
         import traceback
 
         print("Error details", traceback.format_exc())
         raise Exception(f"Error in file: {str(e)}")
+
+
+def modifyToExcel(frame):
+    """
+    Exports the provided export frame to an Excel file (see sendExport).
+
+    Args:
+        frame (pandas.DataFrame): Export frame, as returned by readExportFrame.
+
+    Returns:
+        flask.Response: Excel file as a Flask response.
+    """
+    return sendExport(frame, "xlsx")
@@ -1,5 +1,17 @@
+import hashlib
 import io
-import pandas as pd
+
+# Mapping from the HMIS column headers to the names stored in the database
+column_names = {
+    "HMIS: 9.9- Percentage of children (6-59 months)": "Children (6 - 59 months)",
+    "HMIS: 23.1 & 23.3- Percentage of Children (6-9 yrs)": "Children (6 - 9 years)",
+    "HMIS: 22.1.1 & 22.1.3- Percentage of adolescents (10-19 years)": "Adolescents (10 - 19 years)",
+    "HMIS: 1.2.4- Percentage of Pregnant Women": "Pregnant Women",
+    "HMIS: 6.3- Percentage of mothers": "Mothers",
+    "Index Value (%)": "Index Value",
+    "District Rank": "Rank",
+    "Location": "District",
+}
 
 
 def process_csv_to_json(csv_file):
@@ -31,6 +43,8 @@ def process_csv_to_json(csv_file):
 
     Any errors during this process are caught, and an informative error message is raised.
     """
+    import pandas as pd  # Imported on first use, so workers not handling uploads never load it
+
     try:
         # Read CSV file into a Pandas DataFrame
         file_bytes = csv_file.read()
@@ -38,19 +52,7 @@ def process_csv_to_json(csv_file):
         df = pd.read_csv(file_stream)
 
         # Rename columns for clarity
-        df.rename(
-            columns={
-                "HMIS: 9.9- Percentage of children (6-59 months)": "Children (6 - 59 months)",
-                "HMIS: 23.1 & 23.3- Percentage of Children (6-9 yrs)": "Children (6 - 9 years)",
-                "HMIS: 22.1.1 & 22.1.3- Percentage of adolescents (10-19 years)": "Adolescents (10 - 19 years)",
-                "HMIS: 1.2.4- Percentage of Pregnant Women": "Pregnant Women",
-                "HMIS: 6.3- Percentage of mothers": "Mothers",
-                "Index Value (%)": "Index Value",
-                "District Rank": "Rank",
-                "Location": "District",
-            },
-            inplace=True,
-        )
+        df.rename(columns=column_names, inplace=True)
 
         # Convert DataFrame to JSON records
         json_data = df.to_json(orient="records")
@@ -58,3 +60,44 @@ def process_csv_to_json(csv_file):
 
     except Exception as e:
         raise Exception(f"Error processing the file: {str(e)}")
+
+
+def file_fingerprint(csv_file, chunksize=1024 * 1024):
+    """
+    This function returns the SHA-256 hash of a file's content, as a hex string, and rewinds the file
+    so it can be parsed afterwards. The file is read in chunks of chunksize bytes.
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: csv_file.read(chunksize), b""):
+        digest.update(chunk)
+    csv_file.seek(0)
+    return digest.hexdigest()
+
+
+def iter_csv_records(csv_file, chunksize=1000):
+    """
+    This function reads a CSV file in chunks and yields one record (dict) per row, ready for the database layer.
+
+    Parameters:
+    - csv_file: File-like object
+        The CSV file object to be processed, read directly without copying it into memory first.
+    - chunksize: int
+        The number of rows parsed at a time, which bounds the memory used by the parser.
+
+    Yields:
+    - dict: One row with its columns renamed (see process_csv_to_json) and typed by Pandas.
+      Missing values are yielded as None.
+
+    Unlike process_csv_to_json, the rows never go through a JSON string, so there is no extra copy of the data.
+    Any errors during this process are caught, and an informative error message is raised.
+    """
+    import pandas as pd
+
+    try:
+        for chunk in pd.read_csv(csv_file, chunksize=chunksize):
+            chunk.rename(columns=column_names, inplace=True)
+            chunk = chunk.astype(object).where(chunk.notna(), None)
+            yield from chunk.to_dict("records")
+
+    except Exception as e:
+        raise Exception(f"Error processing the file: {str(e)}")
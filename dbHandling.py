@@ -1,5 +1,13 @@
-from pymongo import UpdateOne
-from pymongo.errors import PyMongoError
+import datetime
+import logging
+import time
+
+from pymongo import DeleteOne, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import ConnectionFailure, DuplicateKeyError, PyMongoError
+
+import requestMetrics
+
+logger = logging.getLogger(__name__)
 
 """
     The website to convert the pdfs to csvs
@@ -25,151 +33,1402 @@ def increment_roman_numeral(roman_numeral):
         raise ValueError("Invalid Roman numeral")
 
 
-def add_to_database(mongo, array_of_dictionaries, type):
+# Roman numerals used to label the quarters of a year, in order
+quarter_numerals = ["I", "II", "III", "IV"]
+
+
+def get_bucket_collection(mongo, type):
     """
-    This function adds data to a MongoDB collection based on the provided type parameter.
-    It handles both quarterly and monthly data differently.
+    This function returns the MongoDB collection holding the time buckets for the provided type parameter.
 
-    The function determines the appropriate MongoDB collection based on the type parameter (either "quarterly" or "monthly").
+    Every bucket is one document per state, district and year:
+    {"state": ..., "district": ..., "year": 2021, "periods": [1, 2, ...], "series": {"Index Value": [...], ...}}
+    For monthly data the periods are month numbers (1 - 12), for quarterly data they are Roman numerals ("I" - "IV").
+    The values of every series are stored in the same order as the periods list.
+    """
+    if type == "quarterly":
+        return mongo.db.anemiaBucketsQuarterly
+    elif type == "monthly":
+        return mongo.db.anemiaBucketsMonthly
+    else:
+        raise ValueError("Invalid type passed")
 
-    It then processes and updates the data in the collection. For quarterly data, it also increments the quarter value (e.g., from "2021_I" to "2021_II").
 
-    The function uses bulk updates for efficiency, and it handles exceptions such as MongoDB errors and invalid type values.
+def next_period(last_period, type):
     """
-    try:
-        # Extracting the state name for MongoDB collection selection
-        selected_document = array_of_dictionaries[0]["District"]
+    This function returns the (year, period) pair that follows the provided one,
+    e.g., (2021, 12) to (2022, 1) for monthly data and (2021, "IV") to (2022, "I") for quarterly data.
 
-        # Selecting the MongoDB collection based on the provided type
-        if type == "quarterly":
-            collection = mongo.db.anemiaDataQuarterly
-        elif type == "monthly":
-            collection = mongo.db.anemiaDataMonthly
-        else:
-            raise ValueError("Invalid type passed")
+    When no period has been recorded yet, the first period of 2021 is returned.
+    """
+    if type == "quarterly":
+        if last_period is None:
+            return (2021, "I")
+        year, roman_numeral = last_period
+        if roman_numeral == "IV":
+            return (year + 1, "I")
+        return (year, increment_roman_numeral(roman_numeral))
+    elif type == "monthly":
+        if last_period is None:
+            return (2021, 1)
+        year, month = last_period
+        if month < 12:
+            return (year, month + 1)
+        return (year + 1, 1)
+    else:
+        raise ValueError("Invalid type passed")
 
-        # Initializing empty lists and variables
-        bulk_updates = []
-        document = collection.find_one({"state": selected_document})
-        if document:
-            data = document.get("data", [])
-            if type == "quarterly":
-                quarters = document.get("quarters", [])
+
+def period_sort_key(period):
+    """
+    This function returns a sortable key for a monthly (int) or quarterly (Roman numeral) period.
+    """
+    if isinstance(period, str):
+        return quarter_numerals.index(period)
+    return period
+
+
+def index_states(array_of_dictionaries):
+    """
+    This function builds a state- and district-keyed index of the uploaded rows in a single pass.
+
+    Files covering many states carry a "State" column, and every row is filed under its own state.
+    Files without that column cover a single state, named by the "District" value of the first row.
+
+    Rows repeating a district are merged into one entry (later values win), so every district
+    receives exactly one value per indicator for the uploaded period.
+    The index keeps the order in which states and districts first appear in the file.
+    """
+    state_index = {}
+    single_state = None
+    for item in array_of_dictionaries:
+        if "State" in item:
+            state = item["State"]
         else:
-            data = []
-            if type == "quarterly":
-                quarters = []
+            if single_state is None:
+                single_state = item["District"]
+            state = single_state
+        values = state_index.setdefault(state, {}).setdefault(item["District"], {})
+        for key, value in item.items():
+            if key != "District" and key != "State":
+                values[key] = value
+    return state_index
 
-        # Iterating through the input data and updating the MongoDB collection
-        for item in array_of_dictionaries:
-            matching_object = next(
-                (obj for obj in data if obj.get("District") == item["District"]),
-                None,
-            )
-            if matching_object:
-                for (
-                    key,
-                    value,
-                ) in item.items():
-                    if key != "District":
-                        if type == "quarterly":
-                            matching_object.setdefault(key, [])
-                            matching_object[key].append(value)
-                        elif type == "monthly":
-                            if len(matching_object[key][-1]["data"]) < 12:
-                                matching_object[key][-1]["data"].append(value)
-                            else:
-                                last_year = matching_object[key][-1]["year"]
-                                new_year = last_year + 1
-                                new_obj = {"year": new_year, "data": [value]}
-                                matching_object[key].append(new_obj)
-                        else:
-                            raise ValueError("Invalid type passed")
+
+def build_bucket_updates(state, district_index, year, period, buckets=None):
+    """
+    This function creates the MongoDB update operations that push one period of values
+    onto the buckets of a state, one UpdateOne per district in the index.
+
+    buckets holds the existing buckets of the state for that year, by district (see find_year_buckets).
+    Every series has to stay aligned with the periods list, so a series missing from the upload gets None
+    for the new period, and a series the bucket doesn't have yet (or that is shorter than its periods)
+    is rewritten padded with None. Districts of the buckets that are missing from the upload get None
+    for every series of the new period. A new bucket records the position of its district in the file
+    ("order"), so GET / can list the districts in upload order.
+    """
+    buckets = buckets or {}
+    bulk_updates = []
+    order = {district: i for i, district in enumerate(district_index)}
+    districts = list(district_index) + [d for d in buckets if d not in district_index]
+    for district in districts:
+        bucket = buckets.get(district, {})
+        values = district_index.get(district, {})
+        series = bucket.get("series", {})
+        position = len(bucket.get("periods", []))
+        push = {"periods": period}
+        padded = {}
+        for key in list(values) + [k for k in series if k not in values]:
+            value = values.get(key)
+            stored = series.get(key)
+            if stored is not None and len(stored) == position:
+                push[f"series.{key}"] = value
             else:
-                new_item = {"District": item["District"]}
-                for key, value in item.items():
-                    if key != "District":
-                        if type == "quarterly":
-                            new_item[key] = [value]
-                        elif type == "monthly":
-                            new_item[key] = [{"year": 2021, "data": [value]}]
-                        else:
-                            raise ValueError("Invalid type passed")
-                data.append(new_item)
-
-        # Incrementing quarterly data if applicable
-        if type == "quarterly":
-            if quarters == []:
-                quarters.append("2021_I")
+                padded[f"series.{key}"] = ((stored or []) + [None] * position)[
+                    :position
+                ] + [value]
+        update = {"$push": push}
+        if padded:
+            update["$set"] = padded
+        if district in order:
+            update["$setOnInsert"] = {"order": order[district]}
+        bulk_updates.append(
+            UpdateOne(
+                {"state": state, "district": district, "year": year},
+                update,
+                upsert=True,
+            )
+        )
+    return bulk_updates
+
+
+def find_year_buckets(collection, years):
+    """
+    This function reads the buckets of the provided states and years ({state: year}) with a single query,
+    and returns them by state and district.
+    """
+    buckets = {state: {} for state in years}
+    for bucket in collection.find(
+        {"state": {"$in": list(years)}, "year": {"$in": list(set(years.values()))}},
+        {"_id": 0, "state": 1, "district": 1, "year": 1, "periods": 1, "series": 1},
+    ):
+        if years[bucket["state"]] == bucket["year"]:
+            buckets[bucket["state"]][bucket["district"]] = bucket
+    return buckets
+
+
+def get_rollup_collection(mongo, type):
+    """
+    This function returns the MongoDB collection holding the rollups for the provided type parameter.
+
+    Every rollup aggregates one period, either of one state or of the whole country:
+    {"level": "state" or "national", "state": ... (None for national), "year": 2021, "period": 1, "districts": 30,
+     "indicators": {"Index Value": {"sum": ..., "count": ..., "min": ..., "max": ...}, ...}}
+    Sums and counts are kept rather than means, so uploads can add to them with $inc.
+    The rows named after their state (the state totals of the HMIS files) are not counted.
+    """
+    if type == "quarterly":
+        return mongo.db.anemiaRollupsQuarterly
+    elif type == "monthly":
+        return mongo.db.anemiaRollupsMonthly
+    else:
+        raise ValueError("Invalid type passed")
+
+
+def rollup_values(district_index, state):
+    """
+    This function aggregates one period of the districts of a state: the number of districts, and the sum,
+    count, minimum and maximum of every indicator. Missing and non-numeric values are skipped,
+    and districts without any value (such as the None padding of the buckets) are not counted.
+    """
+    rollup = {"districts": 0, "indicators": {}}
+    for district, values in district_index.items():
+        if district == state or all(value is None for value in values.values()):
+            continue
+        rollup["districts"] += 1
+        for key, value in values.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if value != value:
+                continue
+            aggregate = rollup["indicators"].get(key)
+            if aggregate is None:
+                rollup["indicators"][key] = {
+                    "sum": value,
+                    "count": 1,
+                    "min": value,
+                    "max": value,
+                }
             else:
-                last_quarter = quarters[-1]
-                year, roman_numeral = last_quarter.split("_")
-                if roman_numeral == "IV":
-                    year = str(int(year) + 1)
-                    roman_numeral = "I"
-                else:
-                    roman_numeral = increment_roman_numeral(roman_numeral)
-                quarters.append(f"{year}_{roman_numeral}")
-
-        # Creating the update document for MongoDB
-        if type == "quarterly":
-            update_document = {
-                "state": selected_document,
-                "data": data,
-                "quarters": quarters,
-            }
-        elif type == "monthly":
-            update_document = {
-                "state": selected_document,
-                "data": data,
-            }
+                aggregate["sum"] += value
+                aggregate["count"] += 1
+                aggregate["min"] = min(aggregate["min"], value)
+                aggregate["max"] = max(aggregate["max"], value)
+    return rollup
+
+
+def merge_rollup(total, rollup):
+    """
+    This function adds a rollup into another one, in place, and returns it.
+    """
+    total["districts"] += rollup["districts"]
+    for key, aggregate in rollup["indicators"].items():
+        current = total["indicators"].get(key)
+        if current is None:
+            total["indicators"][key] = dict(aggregate)
         else:
-            raise ValueError("Invalid type passed")
+            current["sum"] += aggregate["sum"]
+            current["count"] += aggregate["count"]
+            current["min"] = min(current["min"], aggregate["min"])
+            current["max"] = max(current["max"], aggregate["max"])
+    return total
 
-        # Creating the MongoDB update operations
-        if document:
-            bulk_updates.append(
-                UpdateOne({"state": selected_document}, {"$set": update_document})
+
+def build_rollup_update(level, state, year, period, rollup):
+    """
+    This function creates the MongoDB update adding a rollup to the stored rollup of a state or of the country,
+    with $inc for districts, sums and counts and $min / $max for the extremes.
+    """
+    update = {"$inc": {"districts": rollup["districts"]}}
+    for key, aggregate in rollup["indicators"].items():
+        update["$inc"][f"indicators.{key}.sum"] = aggregate["sum"]
+        update["$inc"][f"indicators.{key}.count"] = aggregate["count"]
+        update.setdefault("$min", {})[f"indicators.{key}.min"] = aggregate["min"]
+        update.setdefault("$max", {})[f"indicators.{key}.max"] = aggregate["max"]
+    return UpdateOne(
+        {"level": level, "state": state, "year": year, "period": period},
+        update,
+        upsert=True,
+    )
+
+
+def replace_bucket_period(bucket, period, values, periods=()):
+    """
+    This function returns the periods and series of a bucket with the values of one period replaced.
+
+    GET / rebuilds the series by position, so the bucket keeps every period: a period it doesn't have yet,
+    and the other periods of its state for that year (periods), are inserted in order with None values,
+    and when values is None the period is kept with None values rather than removed.
+    Indicators missing from values are left empty (None) for that period.
+    """
+    current = list(bucket.get("periods", []))
+    aligned = sorted(set(current) | set(periods) | {period}, key=period_sort_key)
+    slots = {p: i for i, p in enumerate(aligned)}
+    series = {}
+    for key, data in bucket.get("series", {}).items():
+        series[key] = [None] * len(aligned)
+        for p, value in zip(current, data):
+            series[key][slots[p]] = value
+    i = slots[period]
+    for data in series.values():
+        data[i] = None
+    for key, value in (values or {}).items():
+        series.setdefault(key, [None] * len(aligned))[i] = value
+    return {"periods": aligned, "series": series}
+
+
+def build_replace_updates(collection, states, state_index, year, period):
+    """
+    This function creates the MongoDB operations that replace one period of the buckets of the provided states
+    with the uploaded values (see replace_bucket_period). Districts missing from the upload keep that period
+    with None values. The existing buckets are read with a single query, and the buckets left unchanged
+    are not written.
+    """
+    buckets = {
+        (bucket["state"], bucket["district"]): bucket
+        for bucket in collection.find(
+            {"state": {"$in": list(states)}, "year": year}, {"_id": 0}
+        )
+    }
+    bulk_updates = []
+    for state in states:
+        district_index = state_index[state]
+        state_buckets = {
+            district: bucket
+            for (bucket_state, district), bucket in buckets.items()
+            if bucket_state == state
+        }
+        periods = set()
+        for bucket in state_buckets.values():
+            periods.update(bucket.get("periods", []))
+        order = {district: i for i, district in enumerate(district_index)}
+        districts = list(district_index) + [
+            district for district in state_buckets if district not in district_index
+        ]
+        for district in districts:
+            bucket = state_buckets.get(district, {})
+            replaced = replace_bucket_period(
+                bucket, period, district_index.get(district), periods
             )
-        else:
+            if bucket and replaced == {
+                "periods": bucket.get("periods"),
+                "series": bucket.get("series"),
+            }:
+                continue
             bulk_updates.append(
                 UpdateOne(
-                    {"state": selected_document}, {"$set": update_document}, upsert=True
+                    {"state": state, "district": district, "year": year},
+                    {"$set": replaced, "$setOnInsert": {"order": order.get(district)}},
+                    upsert=True,
                 )
             )
+    return bulk_updates
 
-        # Performing the bulk write to MongoDB
-        if bulk_updates:
-            collection.bulk_write(bulk_updates)
-            return {"status": "SUCCESS"}
-        else:
-            return {"status": "No data to insert or update"}
+
+def build_rollup_replacement(level, state, year, period, rollup):
+    """
+    This function creates the MongoDB operation that replaces the stored rollup of a state or of the country
+    with the provided one, or deletes it when the rollup has no districts.
+    """
+    key = {"level": level, "state": state, "year": year, "period": period}
+    if not rollup["districts"]:
+        return DeleteOne(key)
+    return ReplaceOne(key, dict(rollup, **key), upsert=True)
+
+
+def rebuild_national_rollup(mongo, type, year, period):
+    """
+    This function recomputes the national rollup of one period from the stored rollups of the states.
+    Unlike sums and counts, minimums and maximums can't be subtracted, so replacing a period merges them again.
+    """
+    collection = get_rollup_collection(mongo, type)
+    total = {"districts": 0, "indicators": {}}
+    for rollup in collection.find(
+        {"level": "state", "year": year, "period": period}, {"_id": 0}
+    ):
+        merge_rollup(
+            total,
+            {
+                "districts": rollup.get("districts", 0),
+                "indicators": rollup.get("indicators", {}),
+            },
+        )
+    collection.bulk_write(
+        [build_rollup_replacement("national", None, year, period, total)]
+    )
+
+
+def upload_key(fingerprint, type):
+    return f"{type}:{fingerprint}"
+
+
+def claim_upload(mongo, fingerprint, type, period=None, timeout=600):
+    """
+    This function records in the "anemiaUploads" collection that an upload is being processed, keyed by the hash
+    of its content and its type, and returns None. When the same content has already been uploaded (or is being
+    uploaded right now) it records nothing and returns the earlier record instead, whose status is "done"
+    (or "processing").
+
+    A claim still "processing" after timeout seconds is considered stale, left by a worker that was killed
+    mid-upload, and is taken over, so the file can be uploaded again.
+
+    An upload for an explicit period is only a duplicate when the same content still fills that period for
+    every state it covers, as recorded in the "anemiaPeriodUploads" collection (see record_upload): once another
+    file has replaced the period, uploading the earlier file again replaces it back. Such an upload isn't
+    claimed here, it is recorded by record_upload once written.
+    """
+    uploads = mongo.db.anemiaUploads
+    key = upload_key(fingerprint, type)
+    if period is not None:
+        record = uploads.find_one({"_id": key, "status": "done"})
+        if record is None:
+            return None
+        # The same content always covers the same states, whatever period it was uploaded for
+        states = sorted({s["state"] for s in record.get("states", [])})
+        year, state_period = period
+        filling = mongo.db.anemiaPeriodUploads.count_documents(
+            {
+                "type": type,
+                "state": {"$in": states},
+                "year": year,
+                "period": state_period,
+                "hash": fingerprint,
+            }
+        )
+        if states and filling == len(states):
+            return record
+        return None
+    now = datetime.datetime.now(datetime.timezone.utc)
+    try:
+        uploads.insert_one(
+            {
+                "_id": key,
+                "hash": fingerprint,
+                "type": type,
+                "status": "processing",
+                "createdAt": now,
+                "claimedAt": now,
+            }
+        )
+        return None
+    except DuplicateKeyError:
+        pass
+    record = uploads.find_one({"_id": key})
+    if record is None:
+        # The claim was released in the meantime
+        return claim_upload(mongo, fingerprint, type, period, timeout)
+    if record.get("status") == "processing":
+        taken = uploads.find_one_and_update(
+            {
+                "_id": key,
+                "status": "processing",
+                "claimedAt": {"$lt": now - datetime.timedelta(seconds=timeout)},
+            },
+            {"$set": {"claimedAt": now}},
+        )
+        if taken is not None:
+            return None
+    return record
+
+
+def record_upload(mongo, fingerprint, type, summary):
+    """
+    This function records a processed upload with the periods it wrote for every state.
+
+    The hash is also recorded in the "anemiaPeriodUploads" collection as the content now filling every
+    (state, period) written, replacing the hash of the upload that filled it before.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    record_period_uploads(mongo, fingerprint, type, summary, now)
+    mongo.db.anemiaUploads.update_one(
+        {"_id": upload_key(fingerprint, type)},
+        {
+            "$set": {
+                "hash": fingerprint,
+                "type": type,
+                "status": "done",
+                "states": summary,
+                "uploadedAt": now,
+            },
+            "$addToSet": {
+                "periods": {"$each": [[s["year"], s["period"]] for s in summary]}
+            },
+            "$setOnInsert": {"createdAt": now},
+        },
+        upsert=True,
+    )
+
+
+def record_period_uploads(mongo, fingerprint, type, summary, now=None):
+    """
+    This function records the hash of the content filling every (state, period) of an upload summary,
+    or None for an upload made without a fingerprint.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    mongo.db.anemiaPeriodUploads.bulk_write(
+        [
+            UpdateOne(
+                {
+                    "type": type,
+                    "state": s["state"],
+                    "year": s["year"],
+                    "period": s["period"],
+                },
+                {"$set": {"hash": fingerprint, "uploadedAt": now}},
+                upsert=True,
+            )
+            for s in summary
+        ],
+        ordered=False,
+    )
+
+
+def release_upload(mongo, fingerprint, type):
+    """
+    This function removes the claim of an upload that failed, so the same file can be uploaded again.
+    """
+    try:
+        mongo.db.anemiaUploads.delete_one(
+            {"_id": upload_key(fingerprint, type), "status": "processing"}
+        )
+    except PyMongoError as e:
+        logger.exception(f"MongoDB Error releasing the upload: {str(e)}")
+
+
+def add_to_database(
+    mongo, array_of_dictionaries, type, period=None, fingerprint=None, claim_timeout=600
+):
+    """
+    This function adds data to a MongoDB collection based on the provided type parameter.
+    It handles both quarterly and monthly data.
+
+    The rows can be a list or any iterable of dictionaries, such as the records streamed by
+    dataProcessing.iter_csv_records; they are consumed in a single pass.
+    A file can cover a single state (named by its first row) or many states (with a "State" column).
+
+    For every state, the period being uploaded is the one that follows the last period recorded for it in
+    the "anemiaPeriods" collection (e.g., from "2021_I" to "2021_II" for quarterly data,
+    or from December 2021 to January 2022 for monthly data).
+
+    Only the buckets of the uploaded period are touched: every row pushes its values onto the bucket of its
+    district for that year, so the cost of an upload does not grow with the history of the state.
+    Those buckets are read first, so that every series stays aligned with the periods (see build_bucket_updates).
+    The updates of all states are sent in one unordered bulk write, as every one of them targets a different bucket.
+    The rollups of the uploaded periods, per state and for the country, are updated in the same pass
+    (see get_rollup_collection).
+
+    An explicit period, a (year, period) pair (see parse_period), replaces that period in place for every state
+    of the file: the buckets get the uploaded values instead of an appended copy, districts missing from the file
+    keep that period with None values, and the rollups of the period are recomputed. The period may also be the one that follows
+    the last period of a state, which appends it as usual, but not a later one, nor one the state has no data for
+    (earlier than its first period, or in a year without any of its buckets).
+
+    With the fingerprint of the file (see dataProcessing.file_fingerprint), an upload whose content has already
+    been processed returns right away with the "DUPLICATE" status and the periods written the first time,
+    without reading the rows (see claim_upload). Retried or double-clicked uploads are thus ignored.
+    While the same content is still being processed, the "IN_PROGRESS" status is returned instead, until
+    its claim gets older than claim_timeout seconds.
+
+    The function returns a per-state summary of the periods written,
+    and it handles exceptions such as MongoDB errors and invalid type values.
+    """
+    claimed = False
+    recorded = False
+    try:
+        if fingerprint is not None:
+            previous = claim_upload(mongo, fingerprint, type, period, claim_timeout)
+            if previous is not None and previous.get("status") == "processing":
+                return {"status": "IN_PROGRESS"}
+            if previous is not None:
+                return {"status": "DUPLICATE", "states": previous.get("states", [])}
+            claimed = period is None
+
+        result = write_upload(mongo, array_of_dictionaries, type, period)
+        if fingerprint is not None and result["status"] == "SUCCESS":
+            record_upload(mongo, fingerprint, type, result["states"])
+            recorded = True
+        elif result["status"] == "SUCCESS":
+            record_period_uploads(mongo, None, type, result["states"])
+        return result
     except PyMongoError as e:
         print(f"MongoDB Error: {str(e)}")
         return {"status": "MongoDB Error"}
+    except ValueError:
+        raise
     except Exception as e:
         raise Exception(f"Error processing the file: {str(e)}")
+    finally:
+        if claimed and not recorded:
+            release_upload(mongo, fingerprint, type)
+
+
+def write_upload(mongo, array_of_dictionaries, type, period=None):
+    """
+    This function writes the rows of an upload to the buckets, rollups and periods (see add_to_database).
+    """
+    # Grouping the rows by state and district (this reads the streamed CSV)
+    with requestMetrics.stage("parse_csv"):
+        state_index = index_states(array_of_dictionaries)
+    if not state_index:
+        return {"status": "No data to insert or update"}
+
+    # Selecting the MongoDB collection based on the provided type
+    collection = get_bucket_collection(mongo, type)
+
+    # Working out the period every state is uploading, with one query for all of them
+    last_periods = {
+        header["state"]: (header["year"], header["period"])
+        for header in mongo.db.anemiaPeriods.find(
+            {"state": {"$in": list(state_index)}, "type": type}
+        )
+    }
+
+    # Creating one push per district into the bucket of its state's new period,
+    # or collecting the states whose existing period is replaced
+    bulk_updates = []
+    period_updates = []
+    summary = []
+    rollup_updates = []
+    national_rollups = {}
+    replaced_states = []
+    appended = {}
+    for state, district_index in state_index.items():
+        following = next_period(last_periods.get(state), type)
+        year, state_period = following if period is None else period
+        if period is not None and (year, period_sort_key(state_period)) > (
+            following[0],
+            period_sort_key(following[1]),
+        ):
+            raise ValueError(
+                f"The period {year}_{state_period} can't be uploaded for {state} "
+                f"before {following[0]}_{following[1]}"
+            )
+        replaced = (year, state_period) != following
+        rollup = rollup_values(district_index, state)
+        if period is not None:
+            rollup_updates.append(
+                build_rollup_replacement("state", state, year, state_period, rollup)
+            )
+        elif rollup["districts"]:
+            rollup_updates.append(
+                build_rollup_update("state", state, year, state_period, rollup)
+            )
+        if replaced:
+            replaced_states.append(state)
+        else:
+            appended[state] = (year, state_period)
+            merge_rollup(
+                national_rollups.setdefault(
+                    (year, state_period), {"districts": 0, "indicators": {}}
+                ),
+                rollup,
+            )
+            period_updates.append(
+                UpdateOne(
+                    {"state": state, "type": type},
+                    {"$set": {"year": year, "period": state_period}},
+                    upsert=True,
+                )
+            )
+        summary.append(
+            {
+                "state": state,
+                "year": year,
+                "period": state_period,
+                "districts": len(district_index),
+                "replaced": replaced,
+            }
+        )
+
+    if appended:
+        buckets = find_year_buckets(
+            collection, {state: year for state, (year, _) in appended.items()}
+        )
+        for state, (year, state_period) in appended.items():
+            bulk_updates.extend(
+                build_bucket_updates(
+                    state, state_index[state], year, state_period, buckets[state]
+                )
+            )
+    if replaced_states:
+        # A replaced period must already hold data of the state
+        year, state_period = period
+        present = set(
+            collection.distinct(
+                "state",
+                {
+                    "state": {"$in": replaced_states},
+                    "year": year,
+                    "periods": state_period,
+                },
+            )
+        )
+        for state in replaced_states:
+            if state not in present:
+                raise ValueError(
+                    f"The period {year}_{state_period} can't be replaced for {state}, "
+                    f"which has no data for it"
+                )
+        bulk_updates.extend(
+            build_replace_updates(collection, replaced_states, state_index, *period)
+        )
+    if period is None:
+        rollup_updates.extend(
+            build_rollup_update("national", None, year, rollup_period, rollup)
+            for (year, rollup_period), rollup in national_rollups.items()
+            if rollup["districts"]
+        )
+
+    # Performing the bulk write to MongoDB, updating the rollups and recording the new periods
+    with requestMetrics.stage("mongo_write"):
+        if bulk_updates:
+            collection.bulk_write(bulk_updates, ordered=False)
+        if rollup_updates:
+            get_rollup_collection(mongo, type).bulk_write(rollup_updates, ordered=False)
+        if period is not None:
+            rebuild_national_rollup(mongo, type, *period)
+        if period_updates:
+            mongo.db.anemiaPeriods.bulk_write(period_updates, ordered=False)
+    requestMetrics.count_documents("mongo_write", len(bulk_updates))
+    return {"status": "SUCCESS", "states": summary}
+
+
+def month_slots(periods, values):
+    """
+    This function places the values of a monthly bucket at the positions of their months (January first),
+    with None for the months the bucket doesn't have, e.g. a district that first appeared in March.
+    """
+    if list(periods[: len(values)]) == list(range(1, len(values) + 1)):
+        return values
+    data = [None] * max(periods, default=0)
+    for month, value in zip(periods, values):
+        data[month - 1] = value
+    return data
+
+
+def finish_state_document(state_document, type, quarters, slots, orders):
+    """
+    This function completes a per-state document once all its buckets have been read: the districts are put
+    back in upload order and, for quarterly data, every series is aligned with the state's quarters list.
+    """
+    state_document["data"].sort(key=lambda d: orders.get(d["District"], float("inf")))
+    if type != "quarterly":
+        return state_document
+    ordered = sorted(quarters, key=lambda q: (q[0], period_sort_key(q[1])))
+    state_document["quarters"] = sorted_quarters(quarters)
+    position = {quarter: i for i, quarter in enumerate(ordered)}
+    for district_object in state_document["data"]:
+        for key, labels in slots.get(district_object["District"], {}).items():
+            if labels == ordered:
+                continue
+            aligned = [None] * len(ordered)
+            for quarter, value in zip(labels, district_object[key]):
+                aligned[position[quarter]] = value
+            district_object[key] = aligned
+    return state_document
+
 
+def iter_state_documents(buckets, type):
+    """
+    This function rebuilds the per-state documents returned by read_database from time buckets,
+    yielding every state as soon as its last bucket has been read.
+
+    The buckets must be sorted by state, district and year. For monthly data every indicator becomes a list of
+    {"year": ..., "data": [...]} objects, for quarterly data every indicator becomes a flat list of values and
+    the state document gets the list of its quarters (e.g., ["2021_I", "2021_II"]).
+    The values are placed by their periods, so a district missing some periods gets None for them and the
+    lists stay positionally aligned. The districts are listed in upload order (the "order" of their buckets).
+    """
+    if type not in ("monthly", "quarterly"):
+        raise ValueError("Invalid type passed")
+    state_document = None
+    district_object = None
+
+    for bucket in buckets:
+        if state_document is None or state_document["state"] != bucket["state"]:
+            if state_document is not None:
+                yield finish_state_document(
+                    state_document, type, quarters, slots, orders
+                )
+            state_document = {"state": bucket["state"], "data": []}
+            district_object = None
+            quarters = set()
+            slots = {}
+            orders = {}
+
+        district = bucket["district"]
+        if district_object is None or district_object["District"] != district:
+            district_object = {"District": district}
+            state_document["data"].append(district_object)
+        if bucket.get("order") is not None:
+            orders[district] = min(
+                orders.get(district, bucket["order"]), bucket["order"]
+            )
+
+        periods = bucket.get("periods", [])
+        for key, values in bucket.get("series", {}).items():
+            if type == "quarterly":
+                district_object.setdefault(key, []).extend(values)
+                slots.setdefault(district, {}).setdefault(key, []).extend(
+                    (bucket["year"], p) for p in periods[: len(values)]
+                )
+            else:
+                district_object.setdefault(key, []).append(
+                    {"year": bucket["year"], "data": month_slots(periods, values)}
+                )
+
+        if type == "quarterly":
+            quarters.update((bucket["year"], p) for p in periods)
+
+    if state_document is not None:
+        yield finish_state_document(state_document, type, quarters, slots, orders)
+
+
+def rebuild_state_documents(buckets, type):
+    """
+    This function rebuilds the list of per-state documents returned by read_database from time buckets
+    (see iter_state_documents).
+    """
+    return list(iter_state_documents(buckets, type))
+
+
+def sorted_quarters(quarters):
+    """
+    This function turns a set of (year, Roman numeral) pairs into the sorted "2021_I" style labels.
+    """
+    return [
+        f"{year}_{roman_numeral}"
+        for year, roman_numeral in sorted(
+            quarters, key=lambda q: (q[0], period_sort_key(q[1]))
+        )
+    ]
+
+
+def parse_quarter(quarter):
+    """
+    This function parses a quarter label such as "2021_II" into a (2021, "II") pair.
+    It raises a ValueError for an invalid label.
+    """
+    try:
+        year, roman_numeral = quarter.split("_")
+        if roman_numeral not in quarter_numerals:
+            raise ValueError
+        return (int(year), roman_numeral)
+    except ValueError:
+        raise ValueError(f"Invalid quarter passed: {quarter}")
+
+
+def parse_period(period, type):
+    """
+    This function parses the label of an upload period into a (year, period) pair:
+    "2022_3" gives (2022, 3) for monthly data, and "2021_II" gives (2021, "II") for quarterly data.
+    It raises a ValueError for an invalid label or type.
+    """
+    if type == "quarterly":
+        return parse_quarter(period)
+    elif type == "monthly":
+        try:
+            year, month = period.split("_")
+            if not 1 <= int(month) <= 12:
+                raise ValueError
+            return (int(year), int(month))
+        except ValueError:
+            raise ValueError(f"Invalid period passed: {period}")
+    else:
+        raise ValueError("Invalid type passed")
+
+
+def build_bucket_query(
+    states=None, districts=None, fields=None, year_from=None, year_to=None
+):
+    """
+    This function creates the MongoDB filter and projection that select the requested buckets.
+
+    States and districts are lists of names, fields is a list of indicator names (only those series are returned),
+    and year_from / year_to bound the bucket years (inclusive). Parameters left as None select everything.
+    """
+    query = {}
+    if states:
+        query["state"] = {"$in": list(states)}
+    if districts:
+        query["district"] = {"$in": list(districts)}
+    if year_from is not None or year_to is not None:
+        query["year"] = {}
+        if year_from is not None:
+            query["year"]["$gte"] = year_from
+        if year_to is not None:
+            query["year"]["$lte"] = year_to
+
+    projection = {"_id": 0}
+    if fields:
+        projection.update(
+            {"state": 1, "district": 1, "year": 1, "periods": 1, "order": 1}
+        )
+        projection.update({f"series.{field}": 1 for field in fields})
+    return query, projection
 
-def read_database(mongo, type):
+
+def trim_bucket(bucket, period_from=None, period_to=None):
+    """
+    This function drops the periods of a bucket that fall outside the (year, period) bounds, both inclusive.
+
+    Only buckets in the first or last year of a range need trimming; the others are returned unchanged.
+    """
+    periods = bucket.get("periods", [])
+    lower = (period_from[0], period_sort_key(period_from[1])) if period_from else None
+    upper = (period_to[0], period_sort_key(period_to[1])) if period_to else None
+    keep = []
+    for i, period in enumerate(periods):
+        position = (bucket["year"], period_sort_key(period))
+        if (lower is None or position >= lower) and (
+            upper is None or position <= upper
+        ):
+            keep.append(i)
+    if len(keep) == len(periods):
+        return bucket
+    bucket["periods"] = [periods[i] for i in keep]
+    bucket["series"] = {
+        key: [values[i] for i in keep if i < len(values)]
+        for key, values in bucket.get("series", {}).items()
+    }
+    return bucket
+
+
+def find_buckets(
+    mongo,
+    type,
+    states=None,
+    districts=None,
+    fields=None,
+    year_from=None,
+    year_to=None,
+    quarter_from=None,
+    quarter_to=None,
+    batch_size=None,
+):
+    """
+    This function returns the requested time buckets of the provided type, sorted by state, district and year.
+
+    The optional filters (see build_bucket_query) are applied by MongoDB, so unrequested states, districts,
+    years and indicators are never read. For quarterly data, quarter_from / quarter_to (e.g., "2021_II")
+    narrow the range further inside the first and last year.
+    batch_size sets how many buckets the cursor fetches per round trip.
+
+    The buckets are read lazily from the MongoDB cursor.
+    """
+    collection = get_bucket_collection(mongo, type)
+    period_from = parse_quarter(quarter_from) if quarter_from else None
+    period_to = parse_quarter(quarter_to) if quarter_to else None
+    if period_from is not None:
+        year_from = max(year_from or period_from[0], period_from[0])
+    if period_to is not None:
+        year_to = min(year_to or period_to[0], period_to[0])
+
+    query, projection = build_bucket_query(
+        states, districts, fields, year_from, year_to
+    )
+    buckets = collection.find(query, projection).sort(
+        [("state", 1), ("district", 1), ("year", 1)]
+    )
+    if batch_size:
+        buckets = buckets.batch_size(batch_size)
+    if period_from is not None or period_to is not None:
+        buckets = (trim_bucket(bucket, period_from, period_to) for bucket in buckets)
+    return buckets
+
+
+def read_database(mongo, type, **filters):
     """
     This function retrieves data from a MongoDB collection based on the provided type parameter (either "quarterly" or "monthly").
 
-    The function determines the appropriate MongoDB collection based on the type parameter and retrieves documents from that collection.
+    The function reads the time buckets of the provided type and rebuilds one document per state from them,
+    in the same shape the API has always returned. The optional filters are those of find_buckets.
+
+    It handles exceptions and raises a ValueError for an invalid type value or quarter label.
+    """
+    try:
+        # The buckets are reshaped while the cursor is read; the waits on the cursor are timed apart
+        buckets = requestMetrics.TimedIteration(
+            "mongo_read", find_buckets(mongo, type, **filters)
+        )
+        start = time.perf_counter()
+        documents = rebuild_state_documents(buckets, type)
+        requestMetrics.record_stage(
+            "reshape", time.perf_counter() - start - buckets.elapsed
+        )
+        return documents
+    except ValueError:
+        raise
+    except Exception as e:
+        raise Exception(f"Error processing the file: {str(e)}")
+
+
+def stream_database(mongo, type, **filters):
+    """
+    This function works like read_database but yields the per-state documents one at a time
+    while the MongoDB cursor is being read, so only one state is held in memory at once.
+    """
+    try:
+        yield from iter_state_documents(find_buckets(mongo, type, **filters), type)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise Exception(f"Error processing the file: {str(e)}")
+
+
+def read_rollups(mongo, type, states=None, year_from=None, year_to=None):
+    """
+    This function returns the stored rollups of the provided type, sorted by state, year and period:
+    those of the requested states, or the national ones when no state is given.
+
+    Every rollup is returned with the mean, minimum, maximum and count of every indicator.
+    One document is read per state and period, whatever the number of districts.
+    """
+    try:
+        query = {"level": "national"}
+        if states:
+            query = {"level": "state", "state": {"$in": list(states)}}
+        if year_from is not None or year_to is not None:
+            query["year"] = {}
+            if year_from is not None:
+                query["year"]["$gte"] = year_from
+            if year_to is not None:
+                query["year"]["$lte"] = year_to
+        rollups = []
+        for document in (
+            get_rollup_collection(mongo, type)
+            .find(query, {"_id": 0})
+            .sort([("state", 1), ("year", 1), ("period", 1)])
+        ):
+            rollup = {
+                "year": document["year"],
+                "period": document["period"],
+                "districts": document["districts"],
+                "indicators": {
+                    key: {
+                        "mean": aggregate["sum"] / aggregate["count"],
+                        "min": aggregate["min"],
+                        "max": aggregate["max"],
+                        "count": aggregate["count"],
+                    }
+                    for key, aggregate in document.get("indicators", {}).items()
+                    if aggregate.get("count")
+                },
+            }
+            if states:
+                rollup["state"] = document["state"]
+            rollups.append(rollup)
+        return rollups
+    except ValueError:
+        raise
+    except Exception as e:
+        raise Exception(f"Error reading the rollups: {str(e)}")
+
+
+def compute_rollups(buckets):
+    """
+    This function computes every rollup from time buckets, keyed by (level, state, year, period).
+    """
+    rollups = {}
+    for bucket in buckets:
+        series = bucket.get("series", {})
+        for i, period in enumerate(bucket.get("periods", [])):
+            values = {key: data[i] for key, data in series.items() if i < len(data)}
+            rollup = rollup_values({bucket["district"]: values}, bucket["state"])
+            if not rollup["districts"]:
+                continue
+            for key in (
+                ("state", bucket["state"], bucket["year"], period),
+                ("national", None, bucket["year"], period),
+            ):
+                merge_rollup(
+                    rollups.setdefault(key, {"districts": 0, "indicators": {}}), rollup
+                )
+    return rollups
+
 
-    It handles exceptions and raises a ValueError for an invalid type value.
+def rollup_differences(key, expected, stored):
+    """
+    This function lists the differences between a recomputed rollup and the stored one (None when missing).
+    """
+    if stored is None:
+        return [f"{key}: missing"]
+    if expected is None:
+        return [f"{key}: not in the data"]
+    differences = []
+    if stored.get("districts") != expected["districts"]:
+        differences.append(
+            f"{key}: districts {stored.get('districts')} != {expected['districts']}"
+        )
+    stored_indicators = stored.get("indicators", {})
+    for indicator in set(expected["indicators"]) | set(stored_indicators):
+        want = expected["indicators"].get(indicator, {})
+        have = stored_indicators.get(indicator, {})
+        for field in ("sum", "count", "min", "max"):
+            a, b = have.get(field), want.get(field)
+            if a is None or b is None:
+                same = a == b
+            else:
+                same = abs(a - b) <= 1e-6 * max(1.0, abs(a), abs(b))
+            if not same:
+                differences.append(f"{key}: {indicator} {field} {a} != {b}")
+    return differences
+
+
+def rebuild_rollups(mongo, type, write=True):
+    """
+    This function recomputes every rollup of the provided type from the time buckets, compares them with the
+    stored ones and, unless write is False, replaces the stored ones with them.
+
+    It returns the number of rollups computed and the list of differences found.
+    """
+    collection = get_rollup_collection(mongo, type)
+    expected = compute_rollups(get_bucket_collection(mongo, type).find({}, {"_id": 0}))
+    stored = {
+        (d["level"], d["state"], d["year"], d["period"]): d
+        for d in collection.find({}, {"_id": 0})
+    }
+    differences = []
+    for key in sorted(set(expected) | set(stored), key=repr):
+        differences.extend(rollup_differences(key, expected.get(key), stored.get(key)))
+
+    if write:
+        operations = [
+            ReplaceOne(
+                {"level": level, "state": state, "year": year, "period": period},
+                dict(rollup, level=level, state=state, year=year, period=period),
+                upsert=True,
+            )
+            for (level, state, year, period), rollup in expected.items()
+        ]
+        operations += [
+            DeleteOne({"level": level, "state": state, "year": year, "period": period})
+            for (level, state, year, period) in stored
+            if (level, state, year, period) not in expected
+        ]
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+    return len(expected), differences
+
+
+def migrate_to_buckets(mongo, type):
+    """
+    This function migrates the legacy per-state documents ("anemiaDataMonthly" / "anemiaDataQuarterly")
+    into time buckets and records the last period of every state.
+
+    Monthly series are split along their existing {"year": ..., "data": [...]} objects.
+    Every bucket keeps the position of its district in the state's data list ("order").
+    Quarterly series are matched positionally with the state's "quarters" list, the same way the API clients read them.
+
+    The migration uses $set upserts, so running it more than once leaves the buckets unchanged.
+    It returns the number of buckets written.
     """
     try:
         if type == "quarterly":
-            collection = mongo.db.anemiaDataQuarterly
+            legacy_collection = mongo.db.anemiaDataQuarterly
         elif type == "monthly":
-            collection = mongo.db.anemiaDataMonthly
+            legacy_collection = mongo.db.anemiaDataMonthly
         else:
             raise ValueError("Invalid type passed")
-        documents = list(collection.find({}, {"_id": 0}))
-        return documents
+        collection = get_bucket_collection(mongo, type)
+
+        written = 0
+        for document in legacy_collection.find({}, {"_id": 0}):
+            state = document["state"]
+            buckets = {}
+            last_period = None
+
+            if type == "quarterly":
+                quarters = [
+                    (int(year), roman_numeral)
+                    for year, roman_numeral in (
+                        q.split("_") for q in document.get("quarters", [])
+                    )
+                ]
+                if quarters:
+                    last_period = quarters[-1]
+
+            for order, district_object in enumerate(document.get("data", [])):
+                district = district_object["District"]
+                for key, series in district_object.items():
+                    if key == "District":
+                        continue
+                    if type == "quarterly":
+                        for (year, roman_numeral), value in zip(quarters, series):
+                            bucket = buckets.setdefault(
+                                (district, year),
+                                {"periods": [], "series": {}, "order": order},
+                            )
+                            if roman_numeral not in bucket["periods"]:
+                                bucket["periods"].append(roman_numeral)
+                            bucket["series"].setdefault(key, []).append(value)
+                    else:
+                        for year_object in series:
+                            year = year_object["year"]
+                            values = year_object["data"]
+                            bucket = buckets.setdefault(
+                                (district, year),
+                                {"periods": [], "series": {}, "order": order},
+                            )
+                            if len(values) > len(bucket["periods"]):
+                                bucket["periods"] = list(range(1, len(values) + 1))
+                            bucket["series"][key] = values
+                            if last_period is None or (year, len(values)) > last_period:
+                                last_period = (year, len(values))
+
+            bulk_updates = [
+                UpdateOne(
+                    {"state": state, "district": district, "year": year},
+                    {"$set": bucket},
+                    upsert=True,
+                )
+                for (district, year), bucket in buckets.items()
+            ]
+            if bulk_updates:
+                collection.bulk_write(bulk_updates, ordered=False)
+                written += len(bulk_updates)
+            if last_period is not None:
+                mongo.db.anemiaPeriods.update_one(
+                    {"state": state, "type": type},
+                    {"$set": {"year": last_period[0], "period": last_period[1]}},
+                    upsert=True,
+                )
+        return written
     except Exception as e:
-        raise Exception(f"Error processing the file: {str(e)}")
+        raise Exception(f"Error migrating the data: {str(e)}")
+
+
+def ensure_indexes(mongo, job_ttl=7 * 24 * 3600):
+    """
+    This function creates the indexes used by the application's queries, and returns their names per collection.
+
+    - buckets: unique (state, district, year), which also serves the sorted reads, and (district, year) for district filters
+    - rollups: unique (level, state, year, period), which also serves the sorted reads
+    - anemiaPeriods: unique (state, type)
+    - anemiaPeriodUploads: unique (type, state, year, period)
+    - userData: unique username, which also makes registration safe against concurrent requests
+    - legacy per-state collections: unique state
+    - jobs: expiry of job records job_ttl seconds after their creation
+
+    Creating an index that already exists does nothing, so the function can be run at every deployment.
+    An index that can't be built (e.g., duplicates in existing data) is reported and skipped.
+    When MongoDB can't be reached the function stops at the first index, rather than waiting for the
+    server selection timeout once per index.
+    """
+    indexes = [
+        (
+            mongo.db.anemiaBucketsMonthly,
+            [("state", 1), ("district", 1), ("year", 1)],
+            {"unique": True},
+        ),
+        (mongo.db.anemiaBucketsMonthly, [("district", 1), ("year", 1)], {}),
+        (
+            mongo.db.anemiaBucketsQuarterly,
+            [("state", 1), ("district", 1), ("year", 1)],
+            {"unique": True},
+        ),
+        (mongo.db.anemiaBucketsQuarterly, [("district", 1), ("year", 1)], {}),
+        (
+            mongo.db.anemiaRollupsMonthly,
+            [("level", 1), ("state", 1), ("year", 1), ("period", 1)],
+            {"unique": True},
+        ),
+        (
+            mongo.db.anemiaRollupsQuarterly,
+            [("level", 1), ("state", 1), ("year", 1), ("period", 1)],
+            {"unique": True},
+        ),
+        (mongo.db.anemiaPeriods, [("state", 1), ("type", 1)], {"unique": True}),
+        (
+            mongo.db.anemiaPeriodUploads,
+            [("type", 1), ("state", 1), ("year", 1), ("period", 1)],
+            {"unique": True},
+        ),
+        (mongo.db.userData, [("username", 1)], {"unique": True}),
+        (mongo.db.anemiaDataMonthly, [("state", 1)], {"unique": True}),
+        (mongo.db.anemiaDataQuarterly, [("state", 1)], {"unique": True}),
+        (mongo.db.jobs, [("createdAt", 1)], {"expireAfterSeconds": job_ttl}),
+    ]
+    created = {}
+    for collection, keys, options in indexes:
+        try:
+            name = collection.create_index(keys, **options)
+            created.setdefault(collection.name, []).append(name)
+        except ConnectionFailure as e:
+            logger.warning(f"MongoDB Error creating the indexes: {str(e)}")
+            break
+        except PyMongoError as e:
+            logger.warning(
+                f"MongoDB Error creating index {keys} on {collection.name}: {str(e)}"
+            )
+    return created
+
+
+def hot_queries(mongo):
+    """
+    This function returns the queries the application runs on every request, as (name, cursor) pairs,
+    for checking their query plans with explain().
+    """
+    queries = []
+    for type in ("monthly", "quarterly"):
+        collection = get_bucket_collection(mongo, type)
+        sort = [("state", 1), ("district", 1), ("year", 1)]
+        for name, filters in [
+            ("all", {}),
+            ("state", {"states": ["state"]}),
+            ("district", {"districts": ["district"]}),
+            ("state and years", {"states": ["state"], "year_from": 2021}),
+        ]:
+            query, projection = build_bucket_query(**filters)
+            queries.append(
+                (
+                    f"{collection.name} by {name}",
+                    collection.find(query, projection).sort(sort),
+                )
+            )
+        rollups = get_rollup_collection(mongo, type)
+        rollup_sort = [("state", 1), ("year", 1), ("period", 1)]
+        queries += [
+            (
+                f"{rollups.name} national",
+                rollups.find({"level": "national"}).sort(rollup_sort),
+            ),
+            (
+                f"{rollups.name} by state",
+                rollups.find({"level": "state", "state": {"$in": ["state"]}}).sort(
+                    rollup_sort
+                ),
+            ),
+        ]
+    queries += [
+        (
+            "anemiaPeriods by state",
+            mongo.db.anemiaPeriods.find(
+                {"state": {"$in": ["state"]}, "type": "monthly"}
+            ),
+        ),
+        ("userData by username", mongo.db.userData.find({"username": "user"})),
+        (
+            "anemiaDataMonthly by state",
+            mongo.db.anemiaDataMonthly.find({"state": "state"}),
+        ),
+        (
+            "anemiaDataQuarterly by state",
+            mongo.db.anemiaDataQuarterly.find({"state": "state"}),
+        ),
+    ]
+    return queries
+
+
+def plan_stages(plan):
+    """
+    This function yields the name of every stage of an explain() plan, walking its input stages.
+    """
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for key in ("inputStage", "queryPlan", "winningPlan"):
+            if key in plan:
+                yield from plan_stages(plan[key])
+        for stage in plan.get("inputStages", []):
+            yield from plan_stages(stage)
+
+
+def check_query_plans(mongo):
+    """
+    This function runs explain() on every hot query and returns (name, stages, uses_collscan) for each of them.
+    """
+    results = []
+    for name, cursor in hot_queries(mongo):
+        explanation = cursor.explain()
+        stages = list(plan_stages(explanation.get("queryPlanner", {})))
+        results.append((name, stages, "COLLSCAN" in stages))
+    return results
+
+
+def read_data_version(mongo):
+    """
+    This function returns the current version of the anemia data, which changes after every successful upload.
+    It is 0 until the first upload.
+    """
+    try:
+        document = mongo.db.dataVersion.find_one({"_id": "anemiaData"})
+        return document["version"] if document else 0
+    except Exception as e:
+        raise Exception(f"Error reading the data version: {str(e)}")
+
+
+def bump_data_version(mongo):
+    """
+    This function increments the version of the anemia data and returns the new version.
+    """
+    try:
+        document = mongo.db.dataVersion.find_one_and_update(
+            {"_id": "anemiaData"},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return document["version"]
+    except Exception as e:
+        raise Exception(f"Error updating the data version: {str(e)}")
+
+
+def create_job(mongo, job_id, kind):
+    """
+    This function records a new background job in the "jobs" collection with the "queued" status.
+    """
+    try:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        mongo.db.jobs.insert_one(
+            {
+                "_id": job_id,
+                "type": kind,
+                "status": "queued",
+                "createdAt": now,
+                "updatedAt": now,
+            }
+        )
+    except Exception as e:
+        raise Exception(f"Error recording the job: {str(e)}")
+
+
+def update_job(mongo, job_id, status, result=None, error=None):
+    """
+    This function updates the status of a background job, with its result or error once it has finished.
+    """
+    try:
+        update = {
+            "status": status,
+            "updatedAt": datetime.datetime.now(datetime.timezone.utc),
+        }
+        if result is not None:
+            update["result"] = result
+        if error is not None:
+            update["error"] = error
+        mongo.db.jobs.update_one({"_id": job_id}, {"$set": update})
+    except Exception as e:
+        raise Exception(f"Error recording the job: {str(e)}")
+
+
+def read_job(mongo, job_id):
+    """
+    This function returns the record of a background job, or None when it doesn't exist.
+    """
+    try:
+        return mongo.db.jobs.find_one({"_id": job_id})
+    except Exception as e:
+        raise Exception(f"Error reading the job: {str(e)}")
 
 
 def register_user(mongo, bcrypt, userData):
@@ -179,6 +1438,7 @@ def register_user(mongo, bcrypt, userData):
     It checks if the provided username already exists in the database.
 
     If not, it hashes the user's password and inserts the user data into the "userData" collection.
+    The unique index on username (see ensure_indexes) rejects a concurrent registration of the same username.
     """
     try:
         collection = mongo.db.userData
@@ -189,7 +1449,11 @@ def register_user(mongo, bcrypt, userData):
             "utf-8"
         )
         new_user = {"username": userData["userName"], "password": hashed_password}
-        collection.insert_one(new_user)
+        try:
+            collection.insert_one(new_user)
+        except DuplicateKeyError:
+            # Another request registered the same username in the meantime
+            return "Username already exists"
         return "success"
     except Exception as e:
         raise Exception(f"Error registering user: {str(e)}")
@@ -201,6 +1465,8 @@ def login_user(mongo, bcrypt, userData):
 
     It first checks if the provided username exists in the database.
     If the username exists, it compares the hashed password with the provided password using the bcrypt library.
+    When the password matches but was hashed with another bcrypt cost than the configured one, it is hashed again
+    and the stored hash is replaced.
     """
     try:
         collection = mongo.db.userData
@@ -208,6 +1474,12 @@ def login_user(mongo, bcrypt, userData):
         if user:
             hashed_password = user.get("password", "")
             if bcrypt.check_password_hash(hashed_password, userData["password"]):
+                if bcrypt.needs_rehash(hashed_password):
+                    new_hash = bcrypt.generate_password_hash(userData["password"])
+                    collection.update_one(
+                        {"_id": user["_id"]},
+                        {"$set": {"password": new_hash.decode("utf-8")}},
+                    )
                 return "User Logged In Successfully"
             else:
                 return "Invalid Password"
@@ -0,0 +1,94 @@
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class ExportCache:
+    """
+    Stores generated export files on local disk, keyed by data version and file name.
+
+    Files are written under a temporary name and renamed into place once complete, so every worker
+    sharing the directory only ever sees finished files. When a new version is built, the files of
+    older versions are removed.
+
+    Args:
+        directory (str): Directory holding the export files.
+        max_workers (int): Number of background threads building exports.
+    """
+
+    def __init__(self, directory, max_workers=1):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def path(self, version, filename):
+        """
+        Returns the path of the export file for the version.
+        """
+        return os.path.join(self.directory, f"{version}-{filename}")
+
+    def get(self, version, filename, build):
+        """
+        Returns the path of the export file for the version, building it first when the cache is cold.
+
+        Args:
+            version (int): Data version the file is built from.
+            filename (str): Name of the export, e.g. "output.xlsx".
+            build (callable): Writes the export to the binary file object it is given.
+        """
+        path = self.path(version, filename)
+        if os.path.exists(path):
+            return path
+        with self._lock:
+            future = self._pending.get((version, filename))
+        if future is not None:
+            future.result()
+            return path
+        self._build(version, filename, build)
+        return path
+
+    def schedule(self, version, filename, build):
+        """
+        Builds the export file for the version in a background thread (see get for the arguments).
+        """
+        with self._lock:
+            if (version, filename) in self._pending:
+                return self._pending[(version, filename)]
+            future = self._executor.submit(self._build, version, filename, build)
+            self._pending[(version, filename)] = future
+        future.add_done_callback(lambda _: self._done(version, filename))
+        return future
+
+    def _done(self, version, filename):
+        with self._lock:
+            self._pending.pop((version, filename), None)
+
+    def _build(self, version, filename, build):
+        path = self.path(version, filename)
+        temporary_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temporary_path, "wb") as output:
+                build(output)
+            os.replace(temporary_path, path)
+        except Exception as e:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            logger.exception(f"Error building the export {filename}: {str(e)}")
+            raise
+        self._prune(version)
+        return path
+
+    def _prune(self, version):
+        for name in os.listdir(self.directory):
+            prefix = name.split("-", 1)[0]
+            if prefix.isdigit() and int(prefix) < version and not name.endswith(".tmp"):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,9 @@
+# Settings read by gunicorn when it is started from this directory (gunicorn app:app)
+
+
+def on_starting(server):
+    # Create the MongoDB indexes once, in the master process, rather than in every worker.
+    # Only the configuration module is imported, so the workers still load the app themselves.
+    import appConfig
+
+    appConfig.bootstrapIndexes()
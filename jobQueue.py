@@ -0,0 +1,84 @@
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import dbHandling
+import requestMetrics
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    """
+    Raised when a job kind already has as many queued and running jobs as it may.
+    """
+
+
+class JobQueue:
+    """
+    Runs background jobs (uploads, exports) in bounded thread pools, one per job kind.
+
+    Every kind has its own number of worker threads and its own limit of queued plus running jobs,
+    so heavy jobs can't take every thread of the process away from the requests it serves.
+    The status and result of every job are recorded in MongoDB (see dbHandling.create_job),
+    so any worker process can answer a status request.
+
+    Args:
+        mongo: MongoDB instance.
+        workers (dict): Number of threads per job kind, e.g. {"upload": 1, "export": 2}.
+        max_pending (int): Maximum number of queued and running jobs per kind.
+        metrics (requestMetrics.MetricsRegistry): Registry the duration and stages of every job are added to,
+            under the route "job:<kind>".
+    """
+
+    def __init__(self, mongo, workers, max_pending=8, metrics=None):
+        self.mongo = mongo
+        self.max_pending = max_pending
+        self.metrics = metrics
+        self._executors = {
+            kind: ThreadPoolExecutor(
+                max_workers=count, thread_name_prefix=f"{kind}-job"
+            )
+            for kind, count in workers.items()
+        }
+        self._pending = {kind: 0 for kind in workers}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, function, *args):
+        """
+        Queues function(*args) as a job of the provided kind and returns the job id right away.
+        The function's return value becomes the job result, and must be storable in MongoDB.
+
+        Raises:
+            JobQueueFull: If the kind has reached its limit of pending jobs.
+        """
+        with self._lock:
+            if self._pending[kind] >= self.max_pending:
+                raise JobQueueFull(f"Too many {kind} jobs, try again later")
+            self._pending[kind] += 1
+
+        try:
+            job_id = uuid.uuid4().hex
+            dbHandling.create_job(self.mongo, job_id, kind)
+            self._executors[kind].submit(self._run, job_id, kind, function, args)
+            return job_id
+        except Exception:
+            self._finished(kind)
+            raise
+
+    def _run(self, job_id, kind, function, args):
+        try:
+            dbHandling.update_job(self.mongo, job_id, "running")
+            with requestMetrics.recorded(self.metrics, f"job:{kind}"):
+                result = function(*args)
+            dbHandling.update_job(self.mongo, job_id, "done", result=result)
+        except Exception as e:
+            logger.exception(f"Job {job_id} failed: {str(e)}")
+            dbHandling.update_job(self.mongo, job_id, "failed", error=str(e))
+        finally:
+            self._finished(kind)
+
+    def _finished(self, kind):
+        with self._lock:
+            self._pending[kind] -= 1
@@ -0,0 +1,186 @@
+import os
+import threading
+
+from pymongo import MongoClient, monitoring
+from pymongo.read_preferences import (
+    Nearest,
+    Primary,
+    PrimaryPreferred,
+    Secondary,
+    SecondaryPreferred,
+)
+
+# Read preferences accepted in MONGO_READ_PREFERENCE
+read_preferences = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Counts connection pool events of a MongoClient, for the pool statistics of this process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {
+            "connectionsCreated": 0,
+            "connectionsClosed": 0,
+            "checkedOut": 0,
+            "checkOutFailures": 0,
+            "poolsCleared": 0,
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._count("poolsCleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._count("connectionsCreated")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count("connectionsClosed")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._count("checkOutFailures")
+
+    def connection_checked_out(self, event):
+        self._count("checkedOut")
+
+    def connection_checked_in(self, event):
+        self._count("checkedOut", -1)
+
+
+class ReadView:
+    """
+    Gives the same .db interface as MongoConnection, with the read preference used for the data reads.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    @property
+    def db(self):
+        return self._connection.database(
+            read_preference=self._connection.read_preference
+        )
+
+
+class MongoConnection:
+    """
+    Creates the MongoClient of the application from the app config, once per process.
+
+    The client is created on first use and again whenever the process id changes, so a connection
+    built before a gunicorn fork is never shared with the workers. Pool size, timeouts and wire
+    compression come from the config (see appConfig.defaultConfig).
+
+    The .db attribute is the database with primary reads, like Flask-PyMongo's; .reads gives the database
+    with the configured read preference (e.g. secondaryPreferred) for the filtered /download reads. Reads whose
+    result is cached under a data version stay on the primary, which has always applied the upload
+    that bumped the version.
+
+    Args:
+        config (dict): The app config.
+    """
+
+    def __init__(self, config):
+        self.uri = config["MONGO_URI"]
+        self.options = {
+            "maxPoolSize": config["MONGO_MAX_POOL_SIZE"],
+            "minPoolSize": config["MONGO_MIN_POOL_SIZE"],
+            "maxIdleTimeMS": config["MONGO_MAX_IDLE_TIME_MS"],
+            "waitQueueTimeoutMS": config["MONGO_WAIT_QUEUE_TIMEOUT_MS"],
+            "connectTimeoutMS": config["MONGO_CONNECT_TIMEOUT_MS"],
+            "socketTimeoutMS": config["MONGO_SOCKET_TIMEOUT_MS"],
+            "serverSelectionTimeoutMS": config["MONGO_SERVER_SELECTION_TIMEOUT_MS"],
+        }
+        if config["MONGO_COMPRESSORS"]:
+            self.options["compressors"] = config["MONGO_COMPRESSORS"]
+        name = config["MONGO_READ_PREFERENCE"]
+        if name not in read_preferences:
+            raise ValueError(f"Invalid read preference: {name}")
+        if name == "primary":
+            self.read_preference = Primary()
+        else:
+            self.read_preference = read_preferences[name](
+                max_staleness=config["MONGO_MAX_STALENESS_SECONDS"]
+            )
+        self.pool_metrics = PoolMetrics()
+        self.reads = ReadView(self)
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                self._client = MongoClient(
+                    self.uri,
+                    connect=False,
+                    event_listeners=[self.pool_metrics],
+                    **self.options,
+                )
+                self._pid = os.getpid()
+            return self._client
+
+    def database(self, read_preference=None):
+        """
+        Returns the database named in the URI, optionally with another read preference.
+        """
+        database = self.client.get_default_database()
+        if read_preference is not None:
+            database = database.with_options(read_preference=read_preference)
+        return database
+
+    @property
+    def db(self):
+        return self.database()
+
+    def close(self):
+        """
+        Closes the client of this process, if it was created.
+        """
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+
+    def pool_stats(self):
+        """
+        Returns the pool settings and the connection counters of this process.
+        """
+        return {
+            "pid": os.getpid(),
+            "maxPoolSize": self.options["maxPoolSize"],
+            "minPoolSize": self.options["minPoolSize"],
+            "compressors": self.options.get("compressors"),
+            "readPreference": self.read_preference.name,
+            **self.pool_metrics.snapshot(),
+        }
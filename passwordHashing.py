@@ -0,0 +1,132 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt as bcryptLibrary
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+
+def hash_password(password, rounds):
+    """
+    Hashes a password with bcrypt at the provided cost. Runs in the hashing processes.
+
+    bcrypt only uses the first 72 bytes of a password, so longer passwords are cut there.
+    """
+    salt = bcryptLibrary.gensalt(rounds=rounds)
+    return bcryptLibrary.hashpw(password.encode("utf-8")[:72], salt)
+
+
+def check_password(hashed_password, password):
+    """
+    Checks a password against a bcrypt hash. Runs in the hashing processes.
+    """
+    if isinstance(hashed_password, str):
+        hashed_password = hashed_password.encode("utf-8")
+    try:
+        return bcryptLibrary.checkpw(password.encode("utf-8")[:72], hashed_password)
+    except ValueError:
+        return False
+
+
+def hash_rounds(hashed_password):
+    """
+    Returns the cost a bcrypt hash was made with, e.g. 12 for "$2b$12$...".
+    """
+    if isinstance(hashed_password, bytes):
+        hashed_password = hashed_password.decode("utf-8")
+    try:
+        return int(hashed_password.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def start_context():
+    """
+    Returns the multiprocessing context the hashing processes are started with: forkserver where available,
+    spawn otherwise. Forking a worker that already runs threads (MongoDB monitors, job and export threads)
+    could copy a lock held by one of them into the child, which would then deadlock on it.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt hashing and checks in a dedicated process pool, so they don't hold the request threads.
+
+    It offers the generate_password_hash / check_password_hash methods of Flask-Bcrypt,
+    plus needs_rehash to upgrade hashes made with another cost.
+    The pool is created on first use in every process, so it is safe to build before a gunicorn fork.
+
+    Args:
+        rounds (int): bcrypt cost of new hashes.
+        max_workers (int): Number of hashing processes, which bounds how many hashes run at once.
+    """
+
+    def __init__(self, rounds=12, max_workers=2):
+        self.rounds = rounds
+        self.max_workers = max_workers
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=start_context()
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def generate_password_hash(self, password):
+        """
+        Returns the bcrypt hash (bytes) of the password at the configured cost.
+        """
+        return self._pool().submit(hash_password, password, self.rounds).result()
+
+    def check_password_hash(self, hashed_password, password):
+        """
+        Tells whether the password matches the hash.
+        """
+        return self._pool().submit(check_password, hashed_password, password).result()
+
+    def needs_rehash(self, hashed_password):
+        """
+        Tells whether the hash was made with a cost other than the configured one.
+        """
+        return hash_rounds(hashed_password) != self.rounds
+
+
+class SessionTokens:
+    """
+    Issues and verifies signed, stateless session tokens.
+
+    A token carries the username and the time it was issued, signed with HMAC using the app's secret key,
+    so verifying it takes no database query and no bcrypt work.
+
+    Args:
+        secret_key (str): Key the tokens are signed with; it must be the same in every worker.
+        max_age (int): Seconds a token stays valid.
+    """
+
+    def __init__(self, secret_key, max_age=86400):
+        self.max_age = max_age
+        self._serializer = URLSafeTimedSerializer(secret_key, salt="session")
+
+    def issue(self, username):
+        """
+        Returns a new token for the user.
+        """
+        return self._serializer.dumps({"username": username})
+
+    def verify(self, token):
+        """
+        Returns the username of a valid token, or None when it is invalid or expired.
+        """
+        try:
+            return self._serializer.loads(token, max_age=self.max_age)["username"]
+        except (BadSignature, KeyError, TypeError):
+            return None
@@ -0,0 +1,300 @@
+import contextlib
+import contextvars
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Upper bounds of the histogram buckets
+duration_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+count_buckets = [1, 10, 100, 1000, 10000, 100000, 1000000]
+size_buckets = [100, 1000, 10000, 100000, 1000000, 10000000, 100000000]
+
+# Recording of the request or job being served by the current thread, if any
+_current = contextvars.ContextVar("recording", default=None)
+
+
+class Histogram:
+    """
+    Cumulative histogram of observations per label values, rendered in the Prometheus text format.
+    """
+
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, labels, value):
+        series = self._series.setdefault(labels, [0] * len(self.buckets) + [0, 0.0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self._series.items()):
+            pairs = [
+                f'{name}="{escape(value)}"' for name, value in zip(self.labels, labels)
+            ]
+            for bound, count in zip(
+                self.buckets + ["+Inf"], series[:-2] + [series[-2]]
+            ):
+                le = ",".join(pairs + [f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{{{le}}} {count}")
+            lines.append(f"{self.name}_sum{{{','.join(pairs)}}} {series[-1]}")
+            lines.append(f"{self.name}_count{{{','.join(pairs)}}} {series[-2]}")
+        return "\n".join(lines)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsRegistry:
+    """
+    Histograms of the requests and background jobs served by this process.
+
+    Every request (or job) is recorded with its route, its total duration and status, the duration of each
+    of its stages (such as parse_csv, mongo_read, reshape, write_xlsx or serialize), the number of
+    documents handled by those stages and the size of the request and response bodies.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.request_duration = Histogram(
+            "anemia_request_duration_seconds",
+            "Duration of the requests and background jobs.",
+            ("route", "method", "status"),
+            duration_buckets,
+        )
+        self.stage_duration = Histogram(
+            "anemia_stage_duration_seconds",
+            "Duration of the stages of the requests and background jobs.",
+            ("route", "stage"),
+            duration_buckets,
+        )
+        self.documents = Histogram(
+            "anemia_stage_documents",
+            "Number of rows or MongoDB documents handled by a stage.",
+            ("route", "stage"),
+            count_buckets,
+        )
+        self.payload_size = Histogram(
+            "anemia_payload_bytes",
+            "Size of the request and response bodies.",
+            ("route", "direction"),
+            size_buckets,
+        )
+
+    def record(self, recording, status, request_bytes=None, response_bytes=None):
+        """
+        Adds a finished recording to the histograms.
+        """
+        route = recording.route
+        with self._lock:
+            self.request_duration.observe(
+                (route, recording.method, str(status)),
+                time.perf_counter() - recording.start,
+            )
+            for stage, duration in recording.stages:
+                self.stage_duration.observe((route, stage), duration)
+            for stage, count in recording.documents:
+                self.documents.observe((route, stage), count)
+            if request_bytes is not None:
+                self.payload_size.observe((route, "request"), request_bytes)
+            if response_bytes is not None:
+                self.payload_size.observe((route, "response"), response_bytes)
+
+    def render(self):
+        """
+        Returns all the histograms in the Prometheus text exposition format.
+        """
+        with self._lock:
+            return (
+                "\n".join(
+                    histogram.render()
+                    for histogram in (
+                        self.request_duration,
+                        self.stage_duration,
+                        self.documents,
+                        self.payload_size,
+                    )
+                )
+                + "\n"
+            )
+
+
+class Recording:
+    """
+    Stage durations and document counts of one request or job, collected while it runs.
+    """
+
+    def __init__(self, route, method):
+        self.route = route
+        self.method = method
+        self.start = time.perf_counter()
+        self.stages = []
+        self.documents = []
+        self.token = None
+
+
+def start_recording(route, method="GET"):
+    """
+    Starts recording the stages of the current request or job, and returns its recording.
+    """
+    recording = Recording(route, method)
+    recording.token = _current.set(recording)
+    return recording
+
+
+def stop_recording(recording):
+    """
+    Stops recording the stages of the current request or job.
+    """
+    if recording.token is not None:
+        _current.reset(recording.token)
+        recording.token = None
+
+
+@contextlib.contextmanager
+def recorded(registry, route, method="JOB"):
+    """
+    Records the stages of the code run in the block, and adds them to the registry at the end.
+    """
+    recording = start_recording(route, method)
+    status = "done"
+    try:
+        yield recording
+    except Exception:
+        status = "failed"
+        raise
+    finally:
+        stop_recording(recording)
+        if registry is not None:
+            registry.record(recording, status)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Times the code run in the block as a stage of the current request or job. Does nothing outside of one.
+    """
+    recording = _current.get()
+    if recording is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def record_stage(name, duration):
+    """
+    Records a stage of the current request or job that was timed by the caller. Does nothing outside of one.
+    """
+    recording = _current.get()
+    if recording is not None:
+        recording.stages.append((name, duration))
+
+
+class TimedIteration:
+    """
+    Iterates over an iterable (e.g. a MongoDB cursor) without holding its items, timing only the waits for them.
+
+    When the iteration ends, the time spent waiting and the number of items are recorded as a stage
+    of the current request or job. The time is also kept in .elapsed, so the caller can leave it out
+    of the stage consuming the items.
+
+    Args:
+        name (str): Name of the stage, e.g. "mongo_read".
+        iterable: The items to iterate over.
+    """
+
+    def __init__(self, name, iterable):
+        self.name = name
+        self.iterable = iterable
+        self.elapsed = 0.0
+        self.count = 0
+
+    def __iter__(self):
+        iterator = iter(self.iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.elapsed += time.perf_counter() - start
+                self.count += 1
+                yield item
+        finally:
+            record_stage(self.name, self.elapsed)
+            count_documents(self.name, self.count)
+
+
+def count_documents(stage, count):
+    """
+    Records the number of rows or documents handled by a stage of the current request or job.
+    """
+    recording = _current.get()
+    if recording is not None:
+        recording.documents.append((stage, count))
+
+
+class SamplingProfiler:
+    """
+    Samples the call stack of one thread at a fixed interval from a background thread.
+
+    The samples are written in the folded stack format ("outer;inner;leaf count" per line),
+    which flamegraph.pl and speedscope can turn into flame graphs.
+
+    Args:
+        thread_id (int): Identifier of the thread to profile (threading.get_ident()).
+        interval (float): Seconds between two samples.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return self
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                )
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        """
+        Writes the samples to path in the folded stack format.
+        """
+        with open(path, "w") as output:
+            for stack, count in self.samples.most_common():
+                output.write(f"{stack} {count}\n")
@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import OrderedDict
+
+import dbHandling
+
+
+class ResponseCache:
+    """
+    An in-process LRU cache for serialized response bodies.
+
+    Entries are keyed by the request parameters and the data version, so an upload makes every older
+    entry unreachable; those entries are then dropped by the LRU bound or when their TTL runs out.
+
+    Args:
+        max_entries (int): Maximum number of entries kept.
+        ttl (float): Seconds an entry stays valid.
+    """
+
+    def __init__(self, max_entries=64, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached value for the key, or None when it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """
+        Stores the value under the key, evicting the least recently used entries over the bound.
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Drops every entry.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+class DataVersion:
+    """
+    Keeps the data version read from MongoDB for a few seconds, so most requests don't need a query to check it.
+
+    An upload handled by this process bumps the version immediately; uploads handled by other
+    processes are seen once the local copy is older than the TTL.
+
+    Args:
+        ttl (float): Seconds the version read from MongoDB is trusted.
+    """
+
+    def __init__(self, ttl=5):
+        self.ttl = ttl
+        self._version = None
+        self._read_at = 0
+        self._lock = threading.Lock()
+
+    def get(self, mongo):
+        """
+        Returns the current data version.
+        """
+        with self._lock:
+            if self._version is None or time.monotonic() - self._read_at > self.ttl:
+                self._version = dbHandling.read_data_version(mongo)
+                self._read_at = time.monotonic()
+            return self._version
+
+    def bump(self, mongo):
+        """
+        Increments the data version after an upload and returns the new version.
+        """
+        with self._lock:
+            self._version = dbHandling.bump_data_version(mongo)
+            self._read_at = time.monotonic()
+            return self._version
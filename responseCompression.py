@@ -0,0 +1,141 @@
+import gzip
+import os
+import shutil
+import threading
+import uuid
+
+# File name suffix of the compressed copies of the export files, per encoding
+encoding_suffixes = {"zstd": ".zst", "br": ".br", "gzip": ".gz"}
+
+# Compression level used when none is configured, per encoding
+default_levels = {"zstd": 10, "br": 5, "gzip": 6}
+
+
+def load_codec(encoding):
+    """
+    Imports the library of an encoding, returning None when it is not installed.
+    gzip is part of the standard library, brotli needs the brotli package and zstd the zstandard package.
+    """
+    try:
+        if encoding == "br":
+            import brotli
+
+            return brotli
+        if encoding == "zstd":
+            import zstandard
+
+            return zstandard
+        if encoding == "gzip":
+            return gzip
+    except ImportError:
+        return None
+    return None
+
+
+class Compression:
+    """
+    Negotiates and applies the Content-Encoding of the responses.
+
+    Args:
+        encodings (list): Encodings offered, in order of preference, e.g. ["zstd", "br", "gzip"].
+            Those whose library is not installed are left out.
+        levels (dict): Compression level per encoding, defaulting to default_levels.
+        min_size (int): Bodies smaller than this many bytes are sent uncompressed.
+        max_size (int): Bodies larger than this many bytes are sent uncompressed (0 for no limit),
+            which bounds the time the first request of a data version spends compressing.
+    """
+
+    def __init__(self, encodings, levels, min_size=1024, max_size=0):
+        self.codecs = {}
+        for encoding in encodings:
+            codec = load_codec(encoding)
+            if codec is not None:
+                self.codecs[encoding] = codec
+        self.levels = dict(default_levels, **(levels or {}))
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def negotiate(self, accept_encodings):
+        """
+        Returns the preferred encoding accepted by the client (werkzeug's request.accept_encodings), or None.
+        """
+        for encoding in self.codecs:
+            if accept_encodings.quality(encoding) > 0:
+                return encoding
+        return None
+
+    def worth_compressing(self, size):
+        return size >= self.min_size and (not self.max_size or size <= self.max_size)
+
+    def compress(self, data, encoding):
+        """
+        Returns data compressed with the encoding.
+        """
+        codec = self.codecs[encoding]
+        level = self.levels[encoding]
+        if encoding == "gzip":
+            return gzip.compress(data, compresslevel=level, mtime=0)
+        if encoding == "br":
+            return codec.compress(data, quality=level)
+        return codec.ZstdCompressor(level=level).compress(data)
+
+    def compress_file(self, path, encoding):
+        """
+        Writes a compressed copy of a file next to it (e.g. "1-output.csv.gz") unless it exists already,
+        and returns its path. The copy is written under a temporary name and renamed into place.
+        """
+        encoded_path = path + encoding_suffixes[encoding]
+        if os.path.exists(encoded_path):
+            return encoded_path
+        temporary_path = f"{encoded_path}.{uuid.uuid4().hex}.tmp"
+        codec = self.codecs[encoding]
+        level = self.levels[encoding]
+        try:
+            with open(path, "rb") as source, open(temporary_path, "wb") as target:
+                if encoding == "gzip":
+                    with gzip.GzipFile(
+                        fileobj=target, mode="wb", compresslevel=level, mtime=0
+                    ) as output:
+                        shutil.copyfileobj(source, output, 1024 * 1024)
+                elif encoding == "br":
+                    compressor = codec.Compressor(quality=level)
+                    for chunk in iter(lambda: source.read(1024 * 1024), b""):
+                        target.write(compressor.process(chunk))
+                    target.write(compressor.finish())
+                else:
+                    codec.ZstdCompressor(level=level).copy_stream(source, target)
+            os.replace(temporary_path, encoded_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        return encoded_path
+
+
+class CompressedBody:
+    """
+    A response body kept together with its compressed variants, each one compressed on its first use.
+    Stored in the response cache, so a body is compressed at most once per encoding and data version.
+
+    Args:
+        body (str or bytes): The uncompressed body.
+        compression (Compression): Settings of the compression.
+    """
+
+    def __init__(self, body, compression):
+        self.body = body.encode() if isinstance(body, str) else body
+        self.compression = compression
+        self._variants = {}
+        self._lock = threading.Lock()
+
+    def encoded(self, encoding):
+        """
+        Returns the body for the negotiated encoding and the Content-Encoding to send (None when uncompressed).
+        """
+        if encoding is None or not self.compression.worth_compressing(len(self.body)):
+            return self.body, None
+        with self._lock:
+            variant = self._variants.get(encoding)
+            if variant is None:
+                variant = self.compression.compress(self.body, encoding)
+                self._variants[encoding] = variant
+        return variant, encoding